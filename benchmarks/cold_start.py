@@ -0,0 +1,73 @@
+"""
+Cold start: importing the app plus serving its first request, each run in a
+fresh interpreter.
+
+    python -m benchmarks.cold_start
+    python -m benchmarks.cold_start --reflect
+
+--reflect also reflects the four tables right after the import, which is
+what every import of src.database did before the tables were declared.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+def child(reflect):
+    start = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+    from src import database as db
+    from src.api.server import app
+
+    if reflect:
+        import sqlalchemy
+
+        sqlalchemy.MetaData().reflect(
+            db.get_engine(), only=["movies", "characters", "lines", "conversations"]
+        )
+    imported = time.perf_counter()
+
+    response = TestClient(app).get("/movies/44")
+    assert response.status_code == 200
+    served = time.perf_counter()
+
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "total_ms": (served - start) * 1000,
+    }))
+
+
+def main(runs, reflect):
+    command = [sys.executable, "-m", "benchmarks.cold_start", "--child"]
+    if reflect:
+        command.append("--reflect")
+
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            command, check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+
+    for key in ("import_ms", "total_ms"):
+        timings = [result[key] for result in results]
+        median = statistics.median(timings)
+        print(f"{key:<10} median {median:>8.1f}  min {min(timings):>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--reflect", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.reflect)
+    else:
+        main(args.runs, args.reflect)
@@ -0,0 +1,68 @@
+"""
+Requests/sec for the read endpoints at high client concurrency.
+
+Start the API in the mode you want to measure, then point this at it:
+
+    DB_ASYNC=1 uvicorn src.api.server:app --port 3000
+    python -m benchmarks.concurrency --url http://127.0.0.1:3000 --clients 200
+
+    DB_ASYNC=0 uvicorn src.api.server:app --port 3000
+    python -m benchmarks.concurrency --url http://127.0.0.1:3000 --clients 200
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+# Mirrors the requests used by the test suite.
+PATHS = [
+    "/characters/7421",
+    "/characters/2",
+    "/characters/?name=amy&limit=50&offset=0&sort=number_of_lines",
+    "/movies/44",
+    "/movies/?name=big&limit=50&offset=0&sort=rating",
+    "/lines/49",
+    "/lines/?movie_id=11",
+    "/line-sort/40700",
+]
+
+
+async def client_loop(client, deadline, counts, worker):
+    i = worker
+    while time.perf_counter() < deadline:
+        response = await client.get(PATHS[i % len(PATHS)])
+        counts[response.status_code < 500] += 1
+        i += 1
+
+
+async def run(url, clients, duration):
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        counts = {True: 0, False: 0}
+        start = time.perf_counter()
+        deadline = start + duration
+        await asyncio.gather(
+            *(
+                client_loop(client, deadline, counts, worker)
+                for worker in range(clients)
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+    total = counts[True] + counts[False]
+    print(f"clients:   {clients}")
+    print(f"requests:  {total} ({counts[False]} errors)")
+    print(f"elapsed:   {elapsed:.2f}s")
+    print(f"req/sec:   {total / elapsed:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:3000")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.clients, args.duration))
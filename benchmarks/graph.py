@@ -0,0 +1,86 @@
+"""
+Latency of the character graph endpoints on the synthetic corpus, next to
+the recursive SQL they replace for a depth-2 neighborhood.
+
+    python -m benchmarks.seed --scale 10 --truncate
+    python -m benchmarks.graph
+
+The first request loads the graph; it is timed separately.
+"""
+import argparse
+import statistics
+import time
+
+import sqlalchemy
+from fastapi.testclient import TestClient
+
+from benchmarks import seed
+from src import database as db
+from src.api.server import app
+
+MOVIE = 3000
+FIRST = MOVIE * seed.CHARACTERS_PER_MOVIE
+PATHS = [
+    f"/characters/{FIRST}/neighbors?depth=1",
+    f"/characters/{FIRST}/neighbors?depth=2",
+    f"/characters/{FIRST}/path/{FIRST + seed.CHARACTERS_PER_MOVIE - 1}",
+    f"/movies/{MOVIE}/centrality",
+]
+
+# what /characters/{id}/neighbors?depth=2 would otherwise run
+recursive_neighbors_stmt = sqlalchemy.text("""
+WITH RECURSIVE reached (character_id, depth) AS (
+    SELECT CAST(:id AS integer), 0
+    UNION
+    SELECT p.partner_id, r.depth + 1
+    FROM reached AS r
+    JOIN character_partners AS p ON p.character_id = r.character_id
+    WHERE r.depth < 2
+)
+SELECT character_id, MIN(depth) FROM reached GROUP BY character_id
+""")
+
+
+def percentiles(timings):
+    timings.sort()
+    return (
+        statistics.median(timings),
+        timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    )
+
+
+def main(runs):
+    client = TestClient(app)
+
+    start = time.perf_counter()
+    assert client.get(PATHS[0]).status_code == 200
+    print(f"first request, graph load: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    print(f"{'path':<50} {'p50 ms':>8} {'p95 ms':>8}")
+    for path in PATHS:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = client.get(path)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200
+        p50, p95 = percentiles(timings)
+        print(f"{path:<50} {p50:>8.2f} {p95:>8.2f}")
+
+    timings = []
+    with db.get_engine().connect() as conn:
+        for _ in range(runs):
+            start = time.perf_counter()
+            conn.execute(recursive_neighbors_stmt, {"id": FIRST}).all()
+            timings.append((time.perf_counter() - start) * 1000)
+    p50, p95 = percentiles(timings)
+    print(f"{'recursive SQL, depth 2':<50} {p50:>8.2f} {p95:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=50)
+    args = parser.parse_args()
+    main(args.runs)
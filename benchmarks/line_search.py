@@ -0,0 +1,77 @@
+"""
+Latency of /lines/search on the synthetic corpus, with and without the
+movie and character filters and for a second page reached by cursor.
+
+    python -m benchmarks.seed --scale 10 --truncate
+    python -m benchmarks.line_search
+    python -m benchmarks.line_search --no-index
+
+--no-index turns off index and bitmap scans for the benchmark's connections,
+so every search reads all of lines. The queries use words from
+benchmarks.seed.LINE_WORDS; "night" matches about one line in four, the
+phrase far fewer.
+"""
+import argparse
+import os
+import statistics
+import time
+
+# Use the sync engine so the planner settings below apply to every request.
+os.environ["DB_ASYNC"] = "0"
+
+import sqlalchemy  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from benchmarks.name_search import disable_index_scans  # noqa: E402
+from src import database as db  # noqa: E402
+from src.api.server import app  # noqa: E402
+
+PATHS = [
+    "/lines/search?q=night",
+    "/lines/search?q=%22never%20again%22",
+    "/lines/search?q=simple%20listen&limit=250",
+    "/lines/search?q=night&movie_id=3000",
+    "/lines/search?q=night&movie_id=3000&character_id=45007",
+]
+
+
+def timed(client, path, runs):
+    client.get(path)  # warm up
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        response = client.get(path)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200
+    timings.sort()
+    return (
+        statistics.median(timings),
+        timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    )
+
+
+def main(runs, no_index):
+    if no_index:
+        sqlalchemy.event.listen(db.get_engine(), "connect", disable_index_scans)
+
+    client = TestClient(app)
+    paths = list(PATHS)
+    cursor = client.get(PATHS[0]).headers.get("X-Next-Cursor")
+    if cursor is not None:
+        paths.append(f"{PATHS[0]}&cursor={cursor}")
+
+    print(f"{'path':<65} {'p50 ms':>8} {'p95 ms':>8}")
+    for path in paths:
+        p50, p95 = timed(client, path, runs)
+        label = path if len(path) <= 65 else path[:62] + "..."
+        print(f"{label:<65} {p50:>8.2f} {p95:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--no-index", action="store_true")
+    args = parser.parse_args()
+    main(args.runs, args.no_index)
@@ -0,0 +1,259 @@
+"""
+Replays a weighted mix of API requests concurrently against the ASGI app
+(in process, no server) and reports per-endpoint throughput, p50/p95/p99
+latency and database queries per request as JSON.
+
+    python -m benchmarks.seed --scale 10 --truncate
+    python -m benchmarks.load --concurrency 32 --duration 30 --out load.json
+
+The list requests are the ones the test fixtures cover; detail requests
+pick random ids from the seeded ranges. The mix includes a few
+conversation writes unless --read-only is given.
+
+Queries per request come from a separate pass that sends each kind of
+request one at a time and counts cursor executions, so concurrent requests
+cannot be charged for each other's queries.
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+
+import httpx
+import sqlalchemy
+
+from benchmarks.seed import CHARACTERS_PER_MOVIE
+from src import database as db
+from src.api.server import app
+
+CHARACTER_LISTS = [
+    "/characters/",
+    "/characters/?name=a&limit=9&offset=50&sort=movie",
+    "/characters/?name=amy&limit=50&offset=0&sort=number_of_lines",
+    "/characters/?name=%20&limit=250&offset=42&sort=movie",
+    "/characters/?name=mooo&limit=50&offset=1000",
+]
+MOVIE_LISTS = [
+    "/movies/",
+    "/movies/?name=big&limit=50&offset=0&sort=rating",
+    "/movies/?name=all&limit=3&offset=0&sort=year",
+    "/movies/?limit=250&offset=200&sort=year",
+    "/movies/?limit=1&offset=50",
+]
+
+
+def add_conversation(rng, ids):
+    movie_id = rng.randrange(ids["movies"])
+    c1 = movie_id * CHARACTERS_PER_MOVIE
+    c2 = c1 + 1
+    body = {
+        "character_1_id": c1,
+        "character_2_id": c2,
+        "lines": [
+            {"character_id": (c1, c2)[i % 2], "line_text": f"load test line {i}"}
+            for i in range(rng.randint(1, 6))
+        ],
+    }
+    return "POST", f"/movies/{movie_id}/conversations/", body
+
+
+# name -> (weight, request factory)
+MIX = {
+    "GET /characters/{id}": (
+        15,
+        lambda rng, ids: (
+            "GET",
+            f"/characters/{rng.randrange(ids['characters'])}",
+            None,
+        ),
+    ),
+    "GET /characters/": (
+        10,
+        lambda rng, ids: ("GET", rng.choice(CHARACTER_LISTS), None),
+    ),
+    "GET /movies/{id}": (
+        15,
+        lambda rng, ids: ("GET", f"/movies/{rng.randrange(ids['movies'])}", None),
+    ),
+    "GET /movies/": (10, lambda rng, ids: ("GET", rng.choice(MOVIE_LISTS), None)),
+    "GET /lines/{id}": (
+        15,
+        lambda rng, ids: ("GET", f"/lines/{rng.randrange(ids['lines'])}", None),
+    ),
+    "GET /lines/?movie_id": (
+        8,
+        lambda rng, ids: (
+            "GET",
+            f"/lines/?movie_id={rng.randrange(ids['movies'])}&limit=50",
+            None,
+        ),
+    ),
+    "GET /lines/?conversation_id": (
+        7,
+        lambda rng, ids: (
+            "GET",
+            f"/lines/?conversation_id={rng.randrange(ids['conversations'])}",
+            None,
+        ),
+    ),
+    "GET /line-sort/{id}": (
+        10,
+        lambda rng, ids: (
+            "GET",
+            f"/line-sort/{rng.randrange(ids['conversations'])}",
+            None,
+        ),
+    ),
+    "POST /movies/{id}/conversations/": (2, add_conversation),
+}
+
+
+def id_ranges():
+    with db.get_engine().connect() as conn:
+        row = conn.execute(sqlalchemy.text("""
+        SELECT (SELECT MAX(movie_id) FROM movies) + 1 AS movies,
+            (SELECT MAX(character_id) FROM characters) + 1 AS characters,
+            (SELECT MAX(conversation_id) FROM conversations) + 1 AS conversations,
+            (SELECT MAX(line_id) FROM lines) + 1 AS lines
+        """)).one()
+    return dict(row._mapping)
+
+
+def percentile_ms(latencies, fraction):
+    """`latencies` are sorted seconds."""
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+
+async def send(client, method, path, body):
+    if method == "GET":
+        return await client.get(path)
+    return await client.post(path, json=body)
+
+
+async def worker(client, rng, ids, names, weights, deadline, results):
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights)[0]
+        method, path, body = MIX[name][1](rng, ids)
+        start = time.perf_counter()
+        response = await send(client, method, path, body)
+        results[name]["latencies"].append(time.perf_counter() - start)
+        if response.status_code >= 500:
+            results[name]["errors"] += 1
+
+
+async def count_queries(client, rng, ids, names, samples):
+    """Average cursor executions per request, one request at a time."""
+    executions = [0]
+
+    def count(*args):
+        executions[0] += 1
+
+    sqlalchemy.event.listen(sqlalchemy.engine.Engine, "before_cursor_execute", count)
+    try:
+        queries = {}
+        for name in names:
+            executions[0] = 0
+            for _ in range(samples):
+                await send(client, *MIX[name][1](rng, ids))
+            queries[name] = executions[0] / samples
+        return queries
+    finally:
+        sqlalchemy.event.remove(
+            sqlalchemy.engine.Engine, "before_cursor_execute", count
+        )
+
+
+async def run(concurrency, duration, read_only, seed):
+    ids = await asyncio.get_running_loop().run_in_executor(None, id_ranges)
+    names = [name for name in MIX if not (read_only and name.startswith("POST"))]
+    weights = [MIX[name][0] for name in names]
+    rng = random.Random(seed)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        queries = await count_queries(client, rng, ids, names, samples=20)
+
+        results = {name: {"latencies": [], "errors": 0} for name in names}
+        deadline = time.perf_counter() + duration
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                worker(
+                    client,
+                    random.Random(seed + i),
+                    ids,
+                    names,
+                    weights,
+                    deadline,
+                    results,
+                )
+                for i in range(concurrency)
+            )
+        )
+        elapsed = time.perf_counter() - start
+
+    endpoints = {}
+    for name in names:
+        latencies = sorted(results[name]["latencies"])
+        endpoints[name] = {
+            "requests": len(latencies),
+            "errors": results[name]["errors"],
+            "requests_per_sec": len(latencies) / elapsed,
+            "p50_ms": percentile_ms(latencies, 0.50),
+            "p95_ms": percentile_ms(latencies, 0.95),
+            "p99_ms": percentile_ms(latencies, 0.99),
+            "queries_per_request": queries[name],
+        }
+
+    all_latencies = sorted(
+        latency for name in names for latency in results[name]["latencies"]
+    )
+    return {
+        "commit": git_commit(),
+        "dataset": ids,
+        "db_async": db.ASYNC_DB,
+        "concurrency": concurrency,
+        "duration_s": elapsed,
+        "requests_per_sec": len(all_latencies) / elapsed,
+        "p50_ms": percentile_ms(all_latencies, 0.50),
+        "p95_ms": percentile_ms(all_latencies, 0.95),
+        "p99_ms": percentile_ms(all_latencies, 0.99),
+        "endpoints": endpoints,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--read-only", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run(args.concurrency, args.duration, args.read_only, args.seed)
+    )
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
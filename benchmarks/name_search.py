@@ -0,0 +1,69 @@
+"""
+Latency of the `name` substring filter on /characters/ and /movies/, using the
+searches from the test fixtures.
+
+    python -m src.maintenance migrate
+    python -m benchmarks.name_search
+    python -m benchmarks.name_search --no-index
+
+--no-index turns off index and bitmap scans for the benchmark's connections,
+which is how every search ran before the trigram indexes existed.
+"""
+import argparse
+import os
+import statistics
+import time
+
+# Use the sync engine so the planner settings below apply to every request.
+os.environ["DB_ASYNC"] = "0"
+
+import sqlalchemy  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from src import database as db  # noqa: E402
+from src.api.server import app  # noqa: E402
+
+PATHS = [
+    "/characters/?name=a&limit=9&offset=50&sort=movie",
+    "/characters/?name=amy&limit=50&offset=0&sort=number_of_lines",
+    "/characters/?name=%20&limit=250&offset=42&sort=movie",
+    "/characters/?name=mooo&limit=50&offset=1000",
+    "/movies/?name=big&limit=50&offset=0&sort=rating",
+    "/movies/?name=all&limit=3&offset=0&sort=year",
+]
+
+
+def disable_index_scans(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET enable_indexscan = off")
+    cursor.execute("SET enable_bitmapscan = off")
+    cursor.close()
+
+
+def main(runs, no_index):
+    if no_index:
+        sqlalchemy.event.listen(db.get_engine(), "connect", disable_index_scans)
+
+    client = TestClient(app)
+    print(f"{'path':<65} {'p50 ms':>8} {'p95 ms':>8}")
+    for path in PATHS:
+        client.get(path)  # warm up
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            response = client.get(path)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 200
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{path:<65} {statistics.median(timings):>8.2f} {p95:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--no-index", action="store_true")
+    args = parser.parse_args()
+    main(args.runs, args.no_index)
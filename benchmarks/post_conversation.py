@@ -0,0 +1,99 @@
+"""
+Write throughput of POST /movies/{movie_id}/conversations/ with 100-line
+conversations.
+
+    uvicorn src.api.server:app --port 3000
+    python -m benchmarks.post_conversation --url http://127.0.0.1:3000
+
+Every run adds real rows, so point it at a scratch database.
+
+Start the server with WRITE_QUEUE=1 to measure queued writes with group
+commit instead. The endpoint then answers 202 before writing, so the run
+also waits for every queued conversation to be reported committed, and
+conv/sec counts committed conversations either way.
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+
+def make_conversation(c1, c2, num_lines):
+    return {
+        "character_1_id": c1,
+        "character_2_id": c2,
+        "lines": [
+            {"character_id": (c1, c2)[i % 2], "line_text": f"benchmark line {i}"}
+            for i in range(num_lines)
+        ],
+    }
+
+
+async def worker(client, path, body, count, latencies, queued):
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await client.post(path, json=body)
+        latencies.append(time.perf_counter() - start)
+        response.raise_for_status()
+        if response.status_code == 202:
+            queued.append(response.json()["conversation_id"])
+
+
+async def wait_committed(client, conversation_ids):
+    for conv_id in conversation_ids:
+        while True:
+            response = await client.get(f"/conversations/{conv_id}/status")
+            response.raise_for_status()
+            if response.json()["status"] != "queued":
+                break
+            await asyncio.sleep(0.01)
+
+
+async def run(url, movie_id, c1, c2, num_lines, clients, per_client):
+    path = f"/movies/{movie_id}/conversations/"
+    body = make_conversation(c1, c2, num_lines)
+    latencies = []
+    queued = []
+    async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                worker(client, path, body, per_client, latencies, queued)
+                for _ in range(clients)
+            )
+        )
+        await wait_committed(client, queued)
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    total = len(latencies)
+    print(f"conversations: {total} x {num_lines} lines, {clients} clients"
+          + (", queued" if queued else ""))
+    print(f"conv/sec:      {total / elapsed:.1f}")
+    print(f"lines/sec:     {total * num_lines / elapsed:.1f}")
+    print(f"p50 ms:        {latencies[total // 2] * 1000:.1f}")
+    print(f"p95 ms:        {latencies[min(total - 1, int(total * 0.95))] * 1000:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--url", default="http://127.0.0.1:3000")
+    parser.add_argument("--movie", type=int, default=240)
+    parser.add_argument("--characters", type=int, nargs=2, default=[3642, 3640])
+    parser.add_argument("--lines", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--per-client", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(
+        run(
+            args.url,
+            args.movie,
+            *args.characters,
+            args.lines,
+            args.clients,
+            args.per_client,
+        )
+    )
@@ -0,0 +1,66 @@
+"""
+Profiles a hot /lines/ request by calling the handler in process, and
+reports the share of time spent compiling SQL.
+
+    python -m benchmarks.profile_lines
+    python -m benchmarks.profile_lines --rebuild
+
+--rebuild constructs the select for every request, as list_lines did before
+its statements were built once at import.
+"""
+import argparse
+import asyncio
+import cProfile
+import pstats
+
+from src.api import lines
+
+
+class Rebuilt(dict):
+    def __getitem__(self, key):
+        return lines.list_lines_statement(*key)
+
+
+async def hot(requests):
+    for _ in range(requests):
+        await lines.list_lines(
+            movie_id=11, conversation_id=None, limit=50, offset=0,
+            sort=lines.line_sort_options.line_id, cursor=None,
+        )
+
+
+def main(requests, rebuild):
+    if rebuild:
+        lines.list_lines_statements = Rebuilt()
+
+    profiler = cProfile.Profile()
+
+    async def run():
+        await hot(10)  # warm up the pool, the compiled cache and prepared statements
+        profiler.enable()
+        await hot(requests)
+        profiler.disable()
+
+    asyncio.run(run())
+    stats = pstats.Stats(profiler)
+
+    total = stats.total_tt
+    compiling = sum(
+        tottime
+        for (filename, _, _), (_, _, tottime, _, _) in stats.stats.items()
+        if "sqlalchemy/sql/" in filename.replace("\\", "/")
+    )
+    print(f"{requests} requests, {total / requests * 1000:.3f} ms each")
+    print(f"sqlalchemy.sql (construction, cache keys, compilation): "
+          f"{compiling / requests * 1000:.3f} ms each, {compiling / total:.1%}")
+    stats.sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rebuild", action="store_true")
+    args = parser.parse_args()
+    main(args.requests, args.rebuild)
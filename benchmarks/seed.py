@@ -0,0 +1,171 @@
+"""
+Fills a scratch database with a synthetic movie dialog corpus shaped like
+the real one (about 617 movies, 9,000 characters, 83,000 conversations and
+290,000 lines at scale 1).
+
+    python -m benchmarks.seed --scale 1
+    python -m benchmarks.seed --scale 10 --truncate
+
+The data is generated from a fixed seed, so every run at the same scale
+produces the same rows. Movie m has characters m * 15 .. m * 15 + 14.
+Refuses to touch a database that already has movies unless --truncate is
+given, which deletes every row in the API's tables.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+import sqlalchemy
+
+from src import database as db
+from src import maintenance
+
+MOVIES = 617
+CHARACTERS_PER_MOVIE = 15
+CONVERSATIONS_PER_MOVIE = 135
+MAX_LINES_PER_CONVERSATION = 6
+BATCH_SIZE = 50000
+
+NAMES = [
+    "AMY", "BIG AL", "JACK", "ROSE", "MORPHEUS", "NEO", "TRINITY", "WILLIAM",
+    "ANNA", "MARLA", "TYLER", "SAM", "FRODO", "ELAINE", "MOOSE", "DALLAS",
+    "RIPLEY", "CAPTAIN", "DOCTOR", "MOTHER", "SALLY", "HARRY", "LOUIS", "ILSA",
+]
+TITLE_WORDS = [
+    "the", "big", "all", "night", "last", "man", "moon", "city", "blue", "return",
+    "of", "matrix", "hollow", "dark", "love", "story", "war", "king", "little", "lost",
+]
+LINE_WORDS = [
+    "I", "you", "don't", "know", "what", "we", "are", "going", "to", "do", "now",
+    "it's", "not", "that", "simple", "listen", "where", "were", "last", "night",
+    "he", "said", "never", "again", "come", "on", "let's", "go", "okay", "why",
+]
+GENDERS = ["M", "F", "?", None]
+
+
+def movie_rows(rng, scale):
+    for m in range(MOVIES * scale):
+        title = " ".join(rng.choice(TITLE_WORDS) for _ in range(rng.randint(1, 4)))
+        yield (
+            m, f"{title} {m}", str(rng.randint(1927, 2010)),
+            round(rng.uniform(2.0, 9.3), 1), rng.randint(100, 500000), None,
+            # num_lines, num_words, num_conversations: filled by the rebuilds below
+            0, 0, 0,
+        )
+
+
+def character_rows(rng, scale):
+    for m in range(MOVIES * scale):
+        for k in range(CHARACTERS_PER_MOVIE):
+            # a few characters have no name, as in the real data
+            name = None if rng.random() < 0.01 else f"{rng.choice(NAMES)} {k}"
+            # num_lines and num_words are filled by the rebuilds below
+            yield (
+                m * CHARACTERS_PER_MOVIE + k,
+                name,
+                m,
+                rng.choice(GENDERS),
+                None,
+                0,
+                0,
+            )
+
+
+def conversation_and_line_rows(rng, scale):
+    """Yields ("conversations", row) and ("lines", row) pairs."""
+    conversation_id = line_id = 0
+    for m in range(MOVIES * scale):
+        first = m * CHARACTERS_PER_MOVIE
+        for _ in range(CONVERSATIONS_PER_MOVIE):
+            c1, c2 = rng.sample(range(first, first + CHARACTERS_PER_MOVIE), 2)
+            conversation_lines = []
+            for line_sort in range(1, rng.randint(1, MAX_LINES_PER_CONVERSATION) + 1):
+                text = " ".join(
+                    rng.choice(LINE_WORDS) for _ in range(rng.randint(2, 14))
+                )
+                speaker = (c1, c2)[line_sort % 2 == 0]
+                conversation_lines.append(
+                    (line_id, speaker, m, conversation_id, line_sort, text)
+                )
+                line_id += 1
+            line_ids = [row[0] for row in conversation_lines]
+            yield "conversations", (conversation_id, c1, c2, m, line_ids, len(line_ids))
+            for row in conversation_lines:
+                yield "lines", row
+            conversation_id += 1
+
+
+async def load(scale):
+    rng = random.Random(scale)
+    batches = {
+        table: [] for table in (db.movies, db.characters, db.conversations, db.lines)
+    }
+
+    async with db.begin() as conn:
+        # COPY has to join an open transaction
+        await conn.execute(sqlalchemy.text("SELECT 1"))
+
+        async def flush(table):
+            # generated columns such as lines.line_tsv are filled by Postgres
+            names = [column.name for column in table.columns if column.computed is None]
+            await db.copy_records(conn, table.name, names, batches[table])
+            batches[table].clear()
+
+        rows = itertools.chain(
+            ((db.movies, row) for row in movie_rows(rng, scale)),
+            ((db.characters, row) for row in character_rows(rng, scale)),
+            (
+                (db.conversations if name == "conversations" else db.lines, row)
+                for name, row in conversation_and_line_rows(rng, scale)
+            ),
+        )
+        for table, row in rows:
+            batches[table].append(row)
+            if len(batches[table]) >= BATCH_SIZE:
+                await flush(table)
+
+        for table in batches:
+            if batches[table]:
+                await flush(table)
+
+
+def main(scale, truncate):
+    start = time.perf_counter()
+    with db.get_engine().begin() as conn:
+        db.metadata_obj.create_all(conn)
+        has_movies = conn.execute(
+            sqlalchemy.text("SELECT 1 FROM movies LIMIT 1")
+        ).first()
+        if has_movies is not None:
+            if not truncate:
+                raise SystemExit(
+                    "movies is not empty; pass --truncate to replace the data"
+                )
+            conn.execute(sqlalchemy.text(
+                "TRUNCATE movies, characters, conversations, lines, "
+                "character_partners, movie_gender_lines"
+            ))
+
+    asyncio.run(load(scale))
+
+    with db.get_engine().begin() as conn:
+        maintenance.migrate(conn)
+        maintenance.rebuild_line_counts(conn)
+        maintenance.rebuild_character_partners(conn)
+        maintenance.rebuild_movie_stats(conn)
+    with db.get_engine().connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(sqlalchemy.text("ANALYZE"))
+
+    print(f"seeded scale {scale} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scale", type=int, default=1, choices=[1, 10, 100])
+    parser.add_argument("--truncate", action="store_true")
+    args = parser.parse_args()
+    main(args.scale, args.truncate)
@@ -0,0 +1,87 @@
+"""
+Cost of turning a 250-row page into a response body: the old per-row dict +
+jsonable_encoder + stdlib json path against responses.rows_response.
+
+    python -m benchmarks.serialization
+
+Runs without Postgres; the rows are real SQLAlchemy Rows from in-memory SQLite.
+"""
+import argparse
+import json
+import timeit
+
+import sqlalchemy
+from fastapi.encoders import jsonable_encoder
+
+from src.api import responses
+from src.api.movies import movie_list_keys
+
+
+def make_rows(num_rows):
+    engine = sqlalchemy.create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text(
+            "CREATE TABLE movies (movie_id integer, title text, year text, "
+            "imdb_rating real, imdb_votes integer)"
+        ))
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO movies VALUES (:id, :title, :year, :rating, :votes)"
+            ),
+            [
+                {
+                    "id": i,
+                    "title": f"movie number {i}",
+                    "year": str(1950 + i % 70),
+                    "rating": 5 + (i % 50) / 10,
+                    "votes": 1000 * i,
+                }
+                for i in range(num_rows)
+            ],
+        )
+        result = conn.execute(sqlalchemy.text(
+            "SELECT movie_id, title, year, imdb_rating, imdb_votes FROM movies"
+        ))
+        return result.keys(), result.all()
+
+
+def old_path(columns, rows):
+    body = []
+    for row in rows:
+        body.append(
+            {
+                "movie_id": row.movie_id,
+                "movie_title": row.title,
+                "year": row.year,
+                "imdb_rating": row.imdb_rating,
+                "imdb_votes": row.imdb_votes,
+            }
+        )
+    # what FastAPI's default JSONResponse does with a returned list
+    return json.dumps(
+        jsonable_encoder(body),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def new_path(columns, rows):
+    return responses.rows_response(columns, rows, movie_list_keys).body
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, default=250)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    columns, rows = make_rows(args.rows)
+    assert json.loads(old_path(columns, rows)) == json.loads(new_path(columns, rows))
+
+    for name, path in [("old", old_path), ("new", new_path)]:
+        seconds = timeit.timeit(lambda: path(columns, rows), number=args.number)
+        print(f"{name}: {seconds / args.number * 1e6:9.1f} us per {args.rows}-row page")
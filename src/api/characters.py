@@ -1,16 +1,133 @@
 from fastapi import APIRouter, HTTPException
 from enum import Enum
-from collections import Counter
 
 from fastapi.params import Query
+import orjson
+from src import cache, graph, snapshot
 from src import database as db
+from src.api import pagination, responses, totals
+from src.api.params import parse_ids
 import sqlalchemy
 
 router = APIRouter()
 
 
+def character_json(char, top_conv):
+    return {
+        "character_id": char.id,
+        "character": char.name,
+        "movie": char.movie,
+        "gender": char.gender,
+        "top_conversations": [
+            {
+                "character_id": conv.id,
+                "character": conv.name,
+                "gender": conv.gender,
+                "number_of_lines_together": conv.num_lines_together,
+            }
+            for conv in top_conv
+        ],
+    }
+
+
+characters_batch_stmt = sqlalchemy.text("""
+SELECT c.character_id AS id, c.name AS name, movies.title AS movie, c.gender AS gender 
+FROM characters AS c 
+JOIN movies ON movies.movie_id = c.movie_id 
+WHERE c.character_id = ANY(:ids)
+""")
+
+top_conversations_batch_stmt = sqlalchemy.text("""
+SELECT character_id, id, name, gender, num_lines_together 
+FROM (
+    SELECT p.character_id, c.character_id AS id, c.name AS name, c.gender AS gender, 
+        p.lines_together AS num_lines_together, 
+        ROW_NUMBER() OVER (
+            PARTITION BY p.character_id ORDER BY p.lines_together DESC, p.partner_id ASC
+        ) AS rank 
+    FROM character_partners AS p 
+    JOIN characters AS c ON c.character_id = p.partner_id 
+    WHERE p.character_id = ANY(:ids)
+) AS ranked 
+WHERE rank <= :limit 
+ORDER BY character_id, rank
+""")
+
+
+@router.get("/characters:batch", tags=["characters"])
+async def get_characters(ids: str, limit: int = Query(50, ge=1, le=250)):
+    """
+    This endpoint returns many characters at once. `ids` is a comma-separated
+    list of up to 250 character ids, e.g. `?ids=1,2,3`.
+
+    It returns:
+    * `results`: an object keyed by character id whose values have the same
+      shape as `/characters/{id}`, with up to `limit` `top_conversations` each.
+    * `missing`: the requested ids that do not exist.
+    """
+    ids = parse_ids(ids)
+
+    async with db.connect() as conn:
+        characters = await conn.execute(characters_batch_stmt, [{"ids": ids}])
+        top_conv = await conn.execute(
+            top_conversations_batch_stmt, [{"ids": ids, "limit": limit}]
+        )
+
+    convs_by_character = {}
+    for conv in top_conv:
+        convs_by_character.setdefault(conv.character_id, []).append(conv)
+
+    results = {
+        char.id: character_json(char, convs_by_character.get(char.id, []))
+        for char in characters
+    }
+
+    return {
+        "results": results,
+        "missing": [id for id in ids if id not in results],
+    }
+
+
+# One round trip: the partners are aggregated into a JSON array next to
+# the character row, already in the response's shape.
+character_stmt = sqlalchemy.text("""
+SELECT c.character_id AS id, c.name AS name, movies.title AS movie, c.gender AS gender, 
+    CAST(COALESCE(top.conversations, '[]') AS text) AS top_conversations 
+FROM characters AS c 
+JOIN movies ON movies.movie_id = c.movie_id 
+CROSS JOIN LATERAL (
+    SELECT json_agg(
+        json_build_object(
+            'character_id', t.id, 
+            'character', t.name, 
+            'gender', t.gender, 
+            'number_of_lines_together', t.num_lines_together
+        ) 
+        ORDER BY t.num_lines_together DESC, t.id ASC
+    ) AS conversations 
+    FROM (
+        SELECT partner.character_id AS id, partner.name AS name, 
+            partner.gender AS gender, 
+            p.lines_together AS num_lines_together 
+        FROM character_partners AS p 
+        JOIN characters AS partner ON partner.character_id = p.partner_id 
+        WHERE p.character_id = c.character_id 
+        ORDER BY p.lines_together DESC, p.partner_id ASC 
+        LIMIT :limit 
+        OFFSET :offset
+    ) AS t
+) AS top 
+WHERE c.character_id = :id
+""")
+
+
 @router.get("/characters/{id}", tags=["characters"])
-def get_character(id: int):
+@cache.cached("character", "id")
+async def get_character(
+    id: int,
+    limit: int = Query(50, ge=1, le=250),
+    offset: int = Query(0, ge=0),
+):
     """
     This endpoint returns a single character by its identifier. For each character
     it returns:
@@ -29,74 +146,205 @@ def get_character(id: int):
     * `gender`: The gender of the character.
     * `number_of_lines_together`: The number of lines the character has with the
       originally queried character.
+
+    The `limit` and `offset` query parameters page through `top_conversations`.
     """
+    if snapshot.current is not None:
+        found = snapshot.current.get_character(id, limit, offset)
+        if found is None:
+            raise HTTPException(status_code=404, detail="character not found.")
+        return character_json(*found)
 
-    character_txt = """
-    SELECT c.character_id AS id, c.name AS name, movies.title AS movie, c.gender AS gender 
-    FROM characters AS c 
-    JOIN movies ON movies.movie_id = c.movie_id 
-    WHERE c.character_id = :id
+    async with db.connect() as conn:
+        result = await conn.execute(
+            character_stmt,
+            [{"id": id, "limit": limit, "offset": offset}]
+        )
+        char = result.first()
+
+    if char is None:
+        raise HTTPException(status_code=404, detail="character not found.")
+
+    return {
+        "character_id": char.id,
+        "character": char.name,
+        "movie": char.movie,
+        "gender": char.gender,
+        "top_conversations": orjson.loads(char.top_conversations),
+    }
+
+
+class character_sort_options(str, Enum):
+    character = "character"
+    movie = "movie"
+    number_of_lines = "number_of_lines"
+
+
+# column label -> response key for list_characters
+character_list_keys = {
+    "id": "character_id",
+    "name": "character",
+    "title": "movie",
+    "num_lines": "number_of_lines",
+}
+
+
+# sort -> (ORDER BY, condition for rows after the cursor, cursor key columns)
+character_sort_sql = {
+    character_sort_options.character: (
+        "name ASC, c.character_id ASC",
+        "(name, c.character_id) > (:after_0, :after_id)",
+        ["name"],
+    ),
+    character_sort_options.movie: (
+        "title ASC, c.character_id ASC",
+        "(movies.title, c.character_id) > (:after_0, :after_id)",
+        ["title"],
+    ),
+    character_sort_options.number_of_lines: (
+        "c.num_lines DESC, title ASC, c.character_id ASC",
+        """(c.num_lines < :after_0 
+        OR (c.num_lines = :after_0 
+            AND (movies.title, c.character_id) > (:after_1, :after_id)))""",
+        ["num_lines", "title"],
+    ),
+}
+
+
+def graph_node(g, id):
+    node = g.index.get(id)
+    if node is None:
+        raise HTTPException(status_code=404, detail="character not found.")
+    return node
+
+
+@router.get("/characters/{id}/neighbors", tags=["characters"])
+async def get_character_neighbors(id: int, depth: int = Query(2, ge=1, le=3)):
     """
+    This endpoint returns the characters within `depth` conversations of a
+    character: its partners at depth 1, their partners at depth 2, and so on.
+    For each one it returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `depth`: How many conversation partners apart the two characters are.
+    * `via`: The character one step closer who has the most lines with this
+      one (the requested character itself at depth 1).
+    * `lines_together`: The number of lines this character and `via` have
+      exchanged.
 
-    top_conv_text = """
-    SELECT c.character_id AS id, c.name AS name, c.gender AS gender, count(*) num_lines_together 
-    FROM characters AS c 
-    JOIN conversations AS conv ON conv.character1_id = c.character_id OR conv.character2_id = c.character_id 
-    JOIN lines ON conv.conversation_id = lines.conversation_id 
-    WHERE (conv.character1_id = :id OR conv.character2_id = :id) AND c.character_id != :id 
-    GROUP BY c.character_id, c.name, c.gender 
-    ORDER BY num_lines_together DESC
+    The characters are ordered by depth, then by `lines_together`.
     """
+    g = await graph.get()
+    node = graph_node(g, id)
+    found = g.within(node, depth)
+    ordered = sorted(
+        found.items(),
+        key=lambda item: (item[1][0], -item[1][2], g.character_ids[item[0]]),
+    )
+    return {
+        "character_id": id,
+        "character": g.names[node],
+        "neighbors": [
+            {
+                "character_id": g.character_ids[n],
+                "character": g.names[n],
+                "depth": hops,
+                "via": g.character_ids[via],
+                "lines_together": lines,
+            }
+            for n, (hops, via, lines) in ordered
+        ],
+    }
 
 
-    with db.engine.connect() as conn:
-        character = conn.execute(
-            sqlalchemy.text(character_txt),
-            [{"id": id}]
-        )
+@router.get("/characters/{id}/path/{other_id}", tags=["characters"])
+async def get_character_path(id: int, other_id: int):
+    """
+    This endpoint returns the shortest chain of conversations connecting two
+    characters: each character in the chain has spoken with the next. It
+    returns:
+    * `length`: The number of conversation links in the chain.
+    * `path`: The characters from `id` to `other_id`, each with its
+      `character_id`, `character` name and the `lines_together` it has
+      exchanged with the previous character (0 for the first).
 
-        top_conv = conn.execute(
-            sqlalchemy.text(top_conv_text),
-            [{"id": id}]
+    Returns 404 if the two characters are not connected.
+    """
+    g = await graph.get()
+    source, target = graph_node(g, id), graph_node(g, other_id)
+    path = g.shortest_path(source, target)
+    if path is None:
+        raise HTTPException(
+            status_code=404, detail="no dialogue path between the characters."
         )
 
-        result = None
-
-        for char in character:
-            result = {
-                "character_id": char.id,
-                "character": char.name,
-                "movie": char.movie,
-                "gender": char.gender,
-                "top_conversations": (
-                    {
-                        "character_id": conv.id,
-                        "character": conv.name,
-                        "gender": conv.gender,
-                        "number_of_lines_together": conv.num_lines_together,
-                    }
-                    for conv in top_conv
+    return {
+        "length": len(path) - 1,
+        "path": [
+            {
+                "character_id": g.character_ids[n],
+                "character": g.names[n],
+                "lines_together": (
+                    g.lines_between(previous, n) if previous is not None else 0
                 ),
             }
+            for previous, n in zip([None] + path[:-1], path)
+        ],
+    }
 
-        if result is None:
-            raise HTTPException(status_code=404, detail="character not found.")
-        
-        return result
-    
 
-class character_sort_options(str, Enum):
-    character = "character"
-    movie = "movie"
-    number_of_lines = "number_of_lines"
+def character_name_filter(by_name):
+    # A trigram index serves the substring match; with no name there is
+    # nothing to match, only unnamed characters to leave out.
+    return "AND name ILIKE :name" if by_name else "AND name IS NOT NULL"
+
+
+def list_characters_statement(sort, by_name, with_cursor):
+    order_by, after, _ = character_sort_sql[sort]
+
+    name_filter = character_name_filter(by_name)
+    after_filter = f"AND {after}" if with_cursor else ""
+
+    return sqlalchemy.text(f"""
+    SELECT c.character_id AS id, name, movies.title AS title, c.num_lines AS num_lines 
+    FROM characters AS c 
+    JOIN movies ON c.movie_id = movies.movie_id 
+    WHERE c.num_lines > 0 {name_filter} {after_filter}
+    ORDER BY {order_by} 
+    LIMIT :limit 
+    OFFSET :offset
+    """)
+
+
+# Every variant is built once, so requests skip parsing the SQL and hit
+# SQLAlchemy's compiled cache and the driver's prepared statements.
+list_characters_statements = {
+    (sort, by_name, with_cursor): list_characters_statement(sort, by_name, with_cursor)
+    for sort in character_sort_options
+    for by_name in (False, True)
+    for with_cursor in (False, True)
+}
+
+
+characters_counters = {
+    by_name: totals.Counter(f"""
+    SELECT 1 
+    FROM characters AS c 
+    JOIN movies ON c.movie_id = movies.movie_id 
+    WHERE c.num_lines > 0 {character_name_filter(by_name)}
+    """)
+    for by_name in (False, True)
+}
 
 
 @router.get("/characters/", tags=["characters"])
-def list_characters(
+async def list_characters(
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: character_sort_options = character_sort_options.character,
+    cursor: str = None,
+    include_total: totals.total_options = None,
 ):
     """
     This endpoint returns a list of characters. For each character it returns:
@@ -118,58 +366,49 @@ def list_characters(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
+
+    When a page is full, the `X-Next-Cursor` response header holds a cursor.
+    Passing it back as the `cursor` query parameter (with the same `name` and
+    `sort`) returns the following page without re-reading the skipped rows.
+
+    `include_total=exact` adds an `X-Total-Count` header with the number of
+    characters matching `name`; `include_total=approximate` adds an
+    `X-Total-Count-Estimate` header with the planner's estimate instead.
     """
 
-    if sort == character_sort_options.character:
-        txt = """
-        SELECT c.character_id AS id, name, movies.title AS title, COUNT(*) num_lines 
-        FROM characters AS c 
-        JOIN movies ON c.movie_id = movies.movie_id 
-        JOIN lines ON c.character_id = lines.character_id 
-        WHERE name ILIKE :name 
-        GROUP BY c.character_id, movies.title 
-        ORDER BY name ASC, c.character_id ASC 
-        LIMIT :limit 
-        OFFSET :offset
-        """
-    elif sort == character_sort_options.movie:
-        txt = """
-        SELECT c.character_id AS id, name, movies.title AS title, COUNT(*) num_lines 
-        FROM characters AS c 
-        JOIN movies ON c.movie_id = movies.movie_id 
-        JOIN lines ON c.character_id = lines.character_id 
-        WHERE name ILIKE :name 
-        GROUP BY c.character_id, movies.title 
-        ORDER BY title ASC 
-        LIMIT :limit 
-        OFFSET :offset
-        """
-    elif sort == character_sort_options.number_of_lines:
-        txt = """
-        SELECT c.character_id AS id, name, movies.title AS title, COUNT(*) num_lines 
-        FROM characters AS c 
-        JOIN movies ON c.movie_id = movies.movie_id 
-        JOIN lines ON c.character_id = lines.character_id 
-        WHERE name ILIKE :name 
-        GROUP BY c.character_id, movies.title 
-        ORDER BY num_lines DESC, title ASC 
-        LIMIT :limit 
-        OFFSET :offset
-        """
+    params = {"limit": limit, "offset": offset}
+    if name != "":
+        params["name"] = db.contains_pattern(name)
+
+    _, _, key_columns = character_sort_sql[sort]
 
-    with db.engine.connect() as conn:
-        result = conn.execute(
-            sqlalchemy.text(txt),
-            [{"name": f"%{name}%", "limit": limit, "offset": offset}]
+    after_cursor = None
+    if cursor is not None:
+        after_cursor = pagination.decode_cursor(cursor, sort.value, len(key_columns))
+        keys, params["after_id"] = after_cursor
+        for i, key in enumerate(keys):
+            params[f"after_{i}"] = key
+
+    if snapshot.current is not None:
+        columns = list(character_list_keys)
+        rows = snapshot.current.list_characters(
+            name, limit, offset, sort.value, after_cursor
         )
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "character_id": row.id,
-                    "character": row.name,
-                    "movie": row.title,
-                    "number_of_lines": row.num_lines,
-                }
-            )
-    return json
+    else:
+        async with db.connect() as conn:
+            stmt = list_characters_statements[sort, name != "", cursor is not None]
+            result = await conn.execute(stmt, [params])
+            columns, rows = result.keys(), result.all()
+
+    response = responses.rows_response(columns, rows, character_list_keys)
+    pagination.set_next_cursor(
+        response, rows, limit,
+        lambda row: pagination.encode_cursor(
+            sort.value, [getattr(row, col) for col in key_columns], row.id
+        ),
+    )
+    await totals.set_total(
+        response, include_total, characters_counters[name != ""],
+        ("characters", name), {"name": params["name"]} if name != "" else {},
+    )
+    return response
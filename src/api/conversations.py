@@ -1,7 +1,14 @@
-from fastapi import APIRouter
+import asyncio
+import logging
+import os
+
+from fastapi import APIRouter, HTTPException, Response
+from src import cache
 from src import database as db
+from src import graph, snapshot
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+from collections import Counter, OrderedDict
 from datetime import datetime
 from src.datatypes import Conversation, Line
 import sqlalchemy
@@ -22,9 +29,224 @@ class ConversationJson(BaseModel):
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
+# character_id -> movie_id. Characters never move between movies, so entries
+# stay valid for the life of the process.
+character_movies = {}
+
+
+async def load_character_movies(conn, character_ids):
+    """Fills `character_movies` for any of `character_ids` not seen yet."""
+    missing = [c_id for c_id in set(character_ids) if c_id not in character_movies]
+    if missing:
+        result = await conn.execute(
+            sqlalchemy.text("""
+            SELECT character_id, movie_id 
+            FROM characters 
+            WHERE character_id = ANY(:ids)
+            """),
+            [{"ids": missing}]
+        )
+        for row in result:
+            character_movies[row.character_id] = row.movie_id
+
+
+def conversation_error(movie_id: int, conversation: ConversationJson) -> Optional[str]:
+    """
+    Returns why `conversation` cannot be added to the movie, or None if it can.
+    Expects `load_character_movies` to have run for its characters.
+    """
+    c1, c2 = conversation.character_1_id, conversation.character_2_id
+
+    if c1 == c2:
+        return "the two characters of a conversation must be different."
+
+    for c_id in (c1, c2):
+        if character_movies.get(c_id) != movie_id:
+            return f"character {c_id} is not part of movie {movie_id}."
+
+    for line in conversation.lines:
+        if line.character_id not in (c1, c2):
+            return f"line speaker {line.character_id} is not part of the conversation."
+
+    return None
+
+
+async def insert_conversation(conn, movie_id: int, conversation: ConversationJson):
+    """Writes a validated conversation, its lines and the derived counts.
+    Returns the new conversation id and the new line ids in line_sort order."""
+    c1, c2 = conversation.character_1_id, conversation.character_2_id
+
+    # One statement writes the conversation, with its line ids in line_sort
+    # order, and its lines: the ids are drawn first so the conversation row
+    # can carry them. line_sort follows the request body order.
+    new_conv_txt = """
+    WITH new_lines AS MATERIALIZED (
+        SELECT 
+            CAST(nextval(pg_get_serial_sequence('lines', 'line_id')) AS integer) 
+                AS line_id, 
+            l.character_id, l.line_text, l.line_sort 
+        FROM unnest(CAST(:character_ids AS integer[]), CAST(:line_texts AS text[])) 
+            WITH ORDINALITY AS l (character_id, line_text, line_sort)
+    ), 
+    new_conv AS (
+        INSERT INTO conversations 
+            (character1_id, character2_id, movie_id, line_ids, num_lines) 
+        SELECT :c1, :c2, :movie_id, 
+            COALESCE(array_agg(line_id ORDER BY line_sort), '{}'), COUNT(*) 
+        FROM new_lines 
+        RETURNING conversation_id, line_ids
+    ), 
+    inserted AS (
+        INSERT INTO lines 
+            (line_id, character_id, movie_id, conversation_id, line_sort, line_text) 
+        SELECT n.line_id, n.character_id, :movie_id, new_conv.conversation_id, 
+            n.line_sort, n.line_text 
+        FROM new_lines AS n, new_conv
+    )
+    SELECT conversation_id, line_ids FROM new_conv
+    """
+
+    result = await conn.execute(
+        sqlalchemy.text(new_conv_txt),
+        [{"c1": c1, "c2": c2, "movie_id": movie_id,
+        "character_ids": [line.character_id for line in conversation.lines],
+        "line_texts": [line.line_text for line in conversation.lines],
+        }]
+    )
+    new_conv_id, line_ids = result.one()
+
+    await update_derived(conn, movie_id, [conversation])
+
+    return new_conv_id, list(line_ids)
+
+
+def word_count(text: str) -> int:
+    """Words in a line: runs of non-whitespace."""
+    return len(text.split())
+
+
+async def update_derived(conn, movie_id: int, conversations: List[ConversationJson]):
+    """Adds newly written conversations to the maintained line and word
+    counts, conversation partners and per-movie statistics."""
+    line_counts = Counter()
+    word_counts = Counter()
+    for conversation in conversations:
+        for line in conversation.lines:
+            line_counts[line.character_id] += 1
+            word_counts[line.character_id] += word_count(line.line_text)
+
+    partner_lines = Counter()
+    for conversation in conversations:
+        c1, c2 = conversation.character_1_id, conversation.character_2_id
+        partner_lines[(c1, c2)] += len(conversation.lines)
+        partner_lines[(c2, c1)] += len(conversation.lines)
+
+    if line_counts:
+        await conn.execute(
+            sqlalchemy.text("""
+            UPDATE characters 
+            SET num_lines = num_lines + :num_lines, num_words = num_words + :num_words 
+            WHERE character_id = :character_id
+            """),
+            # rows go in id order so concurrent writers lock them in the same order
+            [{"character_id": c_id, "num_lines": n, "num_words": word_counts[c_id]}
+            for c_id, n in sorted(line_counts.items())]
+        )
+
+    await conn.execute(
+        sqlalchemy.text("""
+        UPDATE movies 
+        SET num_lines = num_lines + :num_lines, num_words = num_words + :num_words, 
+            num_conversations = num_conversations + :num_conversations 
+        WHERE movie_id = :movie_id
+        """),
+        [
+            {
+                "movie_id": movie_id,
+                "num_lines": sum(line_counts.values()),
+                "num_words": sum(word_counts.values()),
+                "num_conversations": len(conversations),
+            }
+        ],
+    )
+
+    if not line_counts:
+        return
+
+    await conn.execute(
+        sqlalchemy.text("""
+        INSERT INTO movie_gender_lines (movie_id, gender, num_lines) 
+        SELECT :movie_id, COALESCE(c.gender, '?'), SUM(n.num_lines) 
+        FROM unnest(CAST(:character_ids AS integer[]), CAST(:num_lines AS integer[])) 
+            AS n (character_id, num_lines) 
+        JOIN characters AS c ON c.character_id = n.character_id 
+        GROUP BY COALESCE(c.gender, '?') 
+        ORDER BY COALESCE(c.gender, '?') 
+        ON CONFLICT (movie_id, gender) DO UPDATE 
+        SET num_lines = movie_gender_lines.num_lines + EXCLUDED.num_lines
+        """),
+        [{"movie_id": movie_id, "character_ids": list(line_counts),
+        "num_lines": list(line_counts.values())}]
+    )
+
+    await conn.execute(
+        sqlalchemy.text("""
+        INSERT INTO character_partners (character_id, partner_id, lines_together) 
+        VALUES (:character_id, :partner_id, :num_lines) 
+        ON CONFLICT (character_id, partner_id) DO UPDATE 
+        SET lines_together = character_partners.lines_together + EXCLUDED.lines_together
+        """),
+        [{"character_id": a, "partner_id": b, "num_lines": n}
+        for (a, b), n in sorted(partner_lines.items()) if n > 0]
+    )
+
+
+async def committed(movie_id: int, written):
+    """
+    Brings this process's caches up to date with conversations that have just
+    committed. `written` holds a (conversation_id, ConversationJson, line ids)
+    tuple for each one.
+    """
+    character_ids = set()
+    for _, conversation, _ in written:
+        character_ids.update((conversation.character_1_id, conversation.character_2_id))
+
+    # cached detail responses whose line counts just changed
+    cache.detail_cache.invalidate(
+        ("movie", movie_id),
+        ("movie_stats", movie_id),
+        *(("conversation", conv_id) for conv_id, _, _ in written),
+        *(("character", c_id) for c_id in character_ids),
+    )
+
+    for conv_id, conversation, _ in written:
+        graph.add_conversation(
+            conv_id,
+            conversation.character_1_id,
+            conversation.character_2_id,
+            len(conversation.lines),
+        )
+
+    for conv_id, conversation, line_ids in written:
+        snapshot.add_conversation(
+            movie_id, conv_id, conversation.character_1_id, conversation.character_2_id,
+            [
+                (line_id, line.character_id, line_sort, line.line_text)
+                for line_sort, (line_id, line) in enumerate(
+                    zip(line_ids, conversation.lines), start=1
+                )
+            ],
+        )
+
+    await cache.data_version.bump()
+
 
 @router.post("/movies/{movie_id}/conversations/", tags=["movies"])
-def add_conversation(movie_id: int, conversation: ConversationJson):
+async def add_conversation(
+    movie_id: int, conversation: ConversationJson, response: Response
+):
     """
     This endpoint adds a conversation to a movie. The conversation is represented
     by the two characters involved in the conversation and a series of lines between
@@ -38,74 +260,333 @@ def add_conversation(movie_id: int, conversation: ConversationJson):
     request body.
 
     The endpoint returns the id of the resulting conversation that was created.
+
+    When the server runs with `WRITE_QUEUE=1`, the conversation is checked and
+    given its id, then written in the background: the endpoint answers `202`
+    with the id and `status: "queued"`, and
+    `/conversations/{conversation_id}/status` reports when it is committed.
+    A conversation posted while the server shuts down may be refused with `503`.
     """
-    try:
-        last_conv_txt = """
-        SELECT conversation_id 
-        FROM conversations 
-        ORDER BY conversation_id DESC 
-        LIMIT 1
-        """
-
-        last_line_txt = """
-        SELECT line_id 
-        FROM lines 
-        ORDER BY line_id DESC 
-        LIMIT 1
-        """
-
-        with db.engine.begin() as conn:
-            # Add new conversation
-            conv_id = conn.execute(
-                sqlalchemy.text(last_conv_txt)
-            )
+    queue = write_queue
+    if queue is not None:
+        return await enqueue_conversation(queue, movie_id, conversation, response)
 
-            for id in conv_id:
-                new_conv_id = id.conversation_id + 1
+    async with db.begin() as conn:
+        await load_character_movies(
+            conn, [conversation.character_1_id, conversation.character_2_id]
+        )
 
-            new_conv_txt = """
-            INSERT INTO conversations (conversation_id, character1_id, character2_id, movie_id) 
-            VALUES (:conv_id, :c1, :c2, :movie_id)
-            """
+        error = conversation_error(movie_id, conversation)
+        if error is not None:
+            raise HTTPException(status_code=400, detail=error)
 
-            conn.execute(
-                sqlalchemy.text(new_conv_txt),
-                [{"conv_id": new_conv_id, 
-                "c1": conversation.character_1_id, 
-                "c2": conversation.character_2_id, 
-                "movie_id": movie_id,
-                }]
+        new_conv_id, line_ids = await insert_conversation(conn, movie_id, conversation)
+
+    await committed(movie_id, [(new_conv_id, conversation, line_ids)])
+
+    return {"conversation_id": new_conv_id}
+
+
+async def write_conversations(conn, movie_id: int, written):
+    """
+    Writes conversations whose ids are already reserved, with COPY, and adds
+    them to the derived counts. `written` holds (conversation_id,
+    ConversationJson, line ids) tuples, as for `committed`. The COPY joins the
+    open transaction, so `conn` must have run a statement already.
+    """
+    conv_records = []
+    line_records = []
+    for conv_id, conversation, conv_line_ids in written:
+        conv_records.append((
+            conv_id, conversation.character_1_id, conversation.character_2_id, movie_id,
+            conv_line_ids, len(conv_line_ids),
+        ))
+        for line_sort, (line_id, line) in enumerate(
+            zip(conv_line_ids, conversation.lines), start=1
+        ):
+            line_records.append(
+                (
+                    line_id,
+                    line.character_id,
+                    movie_id,
+                    conv_id,
+                    line_sort,
+                    line.line_text,
+                )
             )
 
-            # Add new lines
-            line_id = conn.execute(
-                sqlalchemy.text(last_line_txt)
+    await db.copy_records(
+        conn,
+        "conversations",
+        [
+            "conversation_id",
+            "character1_id",
+            "character2_id",
+            "movie_id",
+            "line_ids",
+            "num_lines",
+        ],
+        conv_records,
+    )
+    await db.copy_records(
+        conn,
+        "lines",
+        [
+            "line_id",
+            "character_id",
+            "movie_id",
+            "conversation_id",
+            "line_sort",
+            "line_text",
+        ],
+        line_records,
+    )
+
+    await update_derived(
+        conn, movie_id, [conversation for _, conversation, _ in written]
+    )
+
+
+async def reserve_ids(conn, table: str, column: str, count: int) -> List[int]:
+    """Takes `count` ids from the sequence behind `table`.`column`."""
+    if count == 0:
+        return []
+    result = await conn.execute(
+        sqlalchemy.text(f"""
+        SELECT nextval(pg_get_serial_sequence('{table}', '{column}')) AS id 
+        FROM generate_series(1, :count)
+        """),
+        [{"count": count}]
+    )
+    return list(result.scalars())
+
+
+@router.post("/movies/{movie_id}/conversations:bulk", tags=["movies"])
+async def add_conversations_bulk(movie_id: int, conversations: List[ConversationJson]):
+    """
+    This endpoint adds many conversations to a movie at once. Each conversation
+    is checked the same way as in `/movies/{movie_id}/conversations/`; the
+    valid ones are written together in one transaction and the invalid ones
+    are skipped.
+
+    The endpoint returns:
+    * `conversations`: for each conversation written, its `index` in the
+      request body and the new `conversation_id`.
+    * `errors`: for each conversation skipped, its `index` and the `detail`
+      of why.
+    """
+    created = []
+    errors = []
+
+    async with db.begin() as conn:
+        character_ids = []
+        for conversation in conversations:
+            character_ids += [conversation.character_1_id, conversation.character_2_id]
+        await load_character_movies(conn, character_ids)
+
+        valid = []
+        for index, conversation in enumerate(conversations):
+            error = conversation_error(movie_id, conversation)
+            if error is None:
+                valid.append((index, conversation))
+            else:
+                errors.append({"index": index, "detail": error})
+
+        if not valid:
+            return {"conversations": created, "errors": errors}
+
+        conv_ids = await reserve_ids(
+            conn, "conversations", "conversation_id", len(valid)
+        )
+        line_ids = iter(await reserve_ids(
+            conn, "lines", "line_id", sum(len(c.lines) for _, c in valid)
+        ))
+
+        written = []
+        for conv_id, (index, conversation) in zip(conv_ids, valid):
+            written.append(
+                (conv_id, conversation, [next(line_ids) for _ in conversation.lines])
             )
+            created.append({"index": index, "conversation_id": conv_id})
+
+        await write_conversations(conn, movie_id, written)
 
-            for id in line_id:
-                new_line_id = id.line_id + 1
-
-            line_sort = 1
-
-            for line in conversation.lines:
-                new_line_txt = """
-                INSERT INTO lines (line_id, character_id ,movie_id, conversation_id, line_sort, line_text) 
-                VALUES (:line_id, :character_id, :movie_id, :conversation_id, :line_sort, :line_text)
-                """
-
-                conn.execute(
-                sqlalchemy.text(new_line_txt),
-                    [{"line_id": new_line_id, 
-                    "character_id": line.character_id,
-                    "movie_id": movie_id,
-                    "conversation_id": new_conv_id,
-                    "line_sort": line_sort,
-                    "line_text": line.line_text
-                    }]
+    await committed(movie_id, written)
+
+    return {"conversations": created, "errors": errors}
+
+
+# -- queued writes -----------------------------------------------------------
+#
+# With WRITE_QUEUE=1, add_conversation only checks a conversation and takes
+# its ids before answering 202; a background worker does the write. The worker
+# takes everything that queued up while its previous transaction committed and
+# writes it in one transaction (group commit), so a burst of posts costs a
+# handful of commits instead of one each. Statuses are kept in this process
+# for the last WRITE_STATUS_SIZE queued conversations.
+
+QUEUE_ENABLED = db.env_flag("WRITE_QUEUE")
+QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", 10000))
+QUEUE_BATCH = int(os.environ.get("WRITE_QUEUE_BATCH", 500))
+STATUS_SIZE = int(os.environ.get("WRITE_STATUS_SIZE", 100000))
+# ids are taken from the sequences at least this many at a time
+ID_BLOCK_SIZE = 1000
+
+# (movie_id, (conversation_id, ConversationJson, line ids)) items, or None
+# while the worker is not running
+write_queue = None
+_writer_task = None
+write_statuses = OrderedDict()
+
+
+class IdBlock:
+    """Ids reserved from a sequence in blocks, so queued writes do not need a
+    round trip each to get theirs."""
+
+    def __init__(self, table, column):
+        self.table = table
+        self.column = column
+        self.ids = []
+
+    async def take(self, count: int) -> List[int]:
+        while len(self.ids) < count:
+            async with db.connect() as conn:
+                self.ids += await reserve_ids(
+                    conn, self.table, self.column, max(count, ID_BLOCK_SIZE)
                 )
+        taken = self.ids[:count]
+        del self.ids[:count]
+        return taken
+
+
+conversation_id_block = IdBlock("conversations", "conversation_id")
+line_id_block = IdBlock("lines", "line_id")
+
+
+def set_status(conv_id: int, status: str, detail: str = None):
+    write_statuses[conv_id] = {"status": status} if detail is None else {
+        "status": status, "detail": detail
+    }
+    write_statuses.move_to_end(conv_id)
+    while len(write_statuses) > STATUS_SIZE:
+        write_statuses.popitem(last=False)
 
-                new_line_id += 1
-                line_sort += 1
 
+async def enqueue_conversation(
+    queue: asyncio.Queue,
+    movie_id: int,
+    conversation: ConversationJson,
+    response: Response,
+):
+    character_ids = [conversation.character_1_id, conversation.character_2_id]
+    if any(c_id not in character_movies for c_id in character_ids):
+        async with db.connect() as conn:
+            await load_character_movies(conn, character_ids)
+
+    error = conversation_error(movie_id, conversation)
+    if error is not None:
+        raise HTTPException(status_code=400, detail=error)
+
+    (conv_id,) = await conversation_id_block.take(1)
+    line_ids = await line_id_block.take(len(conversation.lines))
+
+    if write_queue is not queue:
+        # the writer was stopped while this request waited for its ids
+        raise HTTPException(status_code=503, detail="server is shutting down.")
+
+    set_status(conv_id, "queued")
+    # waits while the queue is full, which slows clients down to the write rate
+    await queue.put((movie_id, (conv_id, conversation, line_ids)))
+
+    response.status_code = 202
+    return {"conversation_id": conv_id, "status": "queued"}
+
+
+async def write_batch(batch):
+    """Writes queued conversations in one transaction. If it fails, each one
+    is retried on its own so one bad conversation does not fail the rest."""
+    by_movie = {}
+    for movie_id, item in batch:
+        by_movie.setdefault(movie_id, []).append(item)
+
+    try:
+        async with db.begin() as conn:
+            # COPY has to join an open transaction
+            await conn.execute(sqlalchemy.text("SELECT 1"))
+            for movie_id, written in sorted(by_movie.items()):
+                await write_conversations(conn, movie_id, written)
+    # COPY raises the driver's own errors, not SQLAlchemy's
     except Exception as error:
-        print(f"Error returned: <<<{error}>>>")
+        if len(batch) > 1:
+            for entry in batch:
+                await write_batch([entry])
+            return
+        logger.exception("queued conversation %s failed", batch[0][1][0])
+        set_status(batch[0][1][0], "failed", str(error))
+        return
+
+    for movie_id, written in by_movie.items():
+        for conv_id, _, _ in written:
+            set_status(conv_id, "committed")
+        await committed(movie_id, written)
+
+
+async def _writer(queue: asyncio.Queue):
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < QUEUE_BATCH and not queue.empty():
+            batch.append(queue.get_nowait())
+        try:
+            await write_batch(batch)
+        except Exception:
+            logger.exception("queued write batch failed")
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+
+def start_writer():
+    """Starts the background writer on the running event loop."""
+    global write_queue, _writer_task
+    write_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    _writer_task = asyncio.create_task(_writer(write_queue))
+
+
+async def stop_writer():
+    """Writes out whatever is still queued, then stops the writer."""
+    global write_queue, _writer_task
+    if _writer_task is None:
+        return
+    queue, write_queue = write_queue, None
+    await queue.join()
+    _writer_task.cancel()
+    _writer_task = None
+
+
+conversation_exists_stmt = sqlalchemy.text("""
+SELECT 1 FROM conversations WHERE conversation_id = :id
+""")
+
+
+@router.get("/conversations/{conversation_id}/status", tags=["movies"])
+async def get_conversation_status(conversation_id: int):
+    """
+    This endpoint reports what happened to a conversation added while the
+    server runs with `WRITE_QUEUE=1`:
+    * `status`: `queued` until it is written, then `committed`, or `failed`
+      with a `detail` if it could not be written.
+
+    Conversations this process no longer tracks are reported `committed` if
+    they exist and 404 otherwise.
+    """
+    status = write_statuses.get(conversation_id)
+    if status is None:
+        async with db.connect() as conn:
+            result = await conn.execute(
+                conversation_exists_stmt, [{"id": conversation_id}]
+            )
+            if result.first() is None:
+                raise HTTPException(status_code=404, detail="conversation not found.")
+        status = {"status": "committed"}
+
+    return {"conversation_id": conversation_id, **status}
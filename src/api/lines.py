@@ -1,13 +1,228 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from enum import Enum
+from src import cache, snapshot
 from src import database as db
+from src.api import pagination, responses, totals
+from src.api.params import parse_ids
 from fastapi.params import Query
 import sqlalchemy
 
 router = APIRouter()
 
+def line_json(line):
+    return {
+        "line_id": line.line_id,
+        "movie_title": line.title,
+        "conversation_id": line.conversation_id,
+        "character": line.name,
+        "line_text": line.line_text
+    }
+
+
+def conv_line_json(c):
+    return {
+        "line_id": c.line_id,
+        "conversation_id": c.conversation_id,
+        "movie_id":  c.movie_id,
+        "line_sort": c.line_sort,
+        "character": c.name,
+        "line_text": c.line_text
+    }
+
+
+lines_batch_stmt = sqlalchemy.text("""
+SELECT line_id, movies.title AS title, conversation_id, characters.name AS name, 
+    line_text 
+FROM lines 
+JOIN movies ON movies.movie_id = lines.movie_id 
+JOIN characters ON characters.character_id = lines.character_id 
+WHERE lines.line_id = ANY(:ids)
+""")
+
+
+@router.get("/lines:batch", tags=["lines"])
+async def get_lines_batch(ids: str):
+    """
+    This endpoint returns many lines at once. `ids` is a comma-separated list
+    of up to 250 line ids, e.g. `?ids=49,50`.
+
+    It returns:
+    * `results`: an object keyed by line id whose values have the same shape
+      as `/lines/{line_id}`.
+    * `missing`: the requested ids that do not exist.
+    """
+    ids = parse_ids(ids)
+
+    async with db.connect() as conn:
+        result = await conn.execute(lines_batch_stmt, [{"ids": ids}])
+
+    results = {line.line_id: line_json(line) for line in result}
+
+    return {
+        "results": results,
+        "missing": [id for id in ids if id not in results],
+    }
+
+
+search_query = sqlalchemy.func.websearch_to_tsquery(
+    sqlalchemy.literal_column("'english'"), sqlalchemy.bindparam("q")
+)
+search_rank = sqlalchemy.func.ts_rank(db.lines.c.line_tsv, search_query)
+
+
+# column label -> response key for search_lines
+line_search_keys = {
+    "line_id": "line_id",
+    "movie_id": "movie_id",
+    "movie_title": "movie_title",
+    "conversation_id": "conversation_id",
+    "character_id": "character_id",
+    "character": "character",
+    "snippet": "snippet",
+    "rank": "rank",
+}
+
+
+def search_lines_statement(by_movie, by_character, variant):
+    # The page is ranked and cut first, so ts_headline (which re-parses the
+    # text) and the joins only run for the rows returned. lines_search_idx
+    # covers the match and both filters.
+    ranked = (
+        sqlalchemy.select(
+            db.lines.c.line_id,
+            db.lines.c.movie_id,
+            db.lines.c.conversation_id,
+            db.lines.c.character_id,
+            db.lines.c.line_text,
+            search_rank.label("rank"),
+        )
+        .where(db.lines.c.line_tsv.op("@@")(search_query))
+        .order_by(sqlalchemy.desc(search_rank), db.lines.c.line_id)
+        .limit(sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer))
+    )
+
+    if by_movie:
+        ranked = ranked.where(db.lines.c.movie_id == sqlalchemy.bindparam("movie_id"))
+
+    if by_character:
+        ranked = ranked.where(
+            db.lines.c.character_id == sqlalchemy.bindparam("character_id")
+        )
+
+    if variant is not None:
+        ranked = ranked.where(
+            pagination.after_bound(
+                search_rank, db.lines.c.line_id, variant, descending=True
+            )
+        )
+
+    ranked = ranked.subquery("ranked")
+    return (
+        sqlalchemy.select(
+            ranked.c.line_id,
+            ranked.c.movie_id,
+            db.movies.c.title.label("movie_title"),
+            ranked.c.conversation_id,
+            ranked.c.character_id,
+            db.characters.c.name.label("character"),
+            sqlalchemy.func.ts_headline(
+                sqlalchemy.literal_column("'english'"), ranked.c.line_text, search_query
+            ).label("snippet"),
+            ranked.c.rank,
+        )
+        .select_from(ranked)
+        .join(db.movies, db.movies.c.movie_id == ranked.c.movie_id)
+        .join(db.characters, db.characters.c.character_id == ranked.c.character_id)
+        .order_by(sqlalchemy.desc(ranked.c.rank), ranked.c.line_id)
+    )
+
+
+# Every variant is built once, so requests skip statement construction and
+# hit SQLAlchemy's compiled cache and the driver's prepared statements. The
+# rank is never NULL, so cursors only come in the "key" variant.
+search_lines_statements = {
+    (by_movie, by_character, variant): search_lines_statement(
+        by_movie, by_character, variant
+    )
+    for by_movie in (False, True)
+    for by_character in (False, True)
+    for variant in (None, "key")
+}
+
+
+@router.get("/lines/search", tags=["lines"])
+async def search_lines(
+    q: str = Query(..., min_length=1),
+    movie_id: int = None,
+    character_id: int = None,
+    limit: int = Query(50, ge=1, le=250),
+    cursor: str = None,
+):
+    """
+    This endpoint searches the text of every line. `q` takes web-search
+    syntax: words are matched in any form ("talk" finds "talking"),
+    `"quoted phrases"` must appear together, `or` gives alternatives and
+    `-word` excludes a word. The results can be narrowed with `movie_id` and
+    `character_id`. For each matching line it returns:
+    * `line_id`: the internal id of the line.
+    * `movie_id`: the movie the line is from.
+    * `movie_title`: The title of that movie.
+    * `conversation_id`: the conversation the line is spoken in.
+    * `character_id`: the character who says the line.
+    * `character`: that character's name.
+    * `snippet`: the line text with the matching words wrapped in `<b>` tags.
+    * `rank`: how well the line matches `q`.
+
+    The best matches come first. When a page is full, the `X-Next-Cursor`
+    response header holds a cursor. Passing it back as the `cursor` query
+    parameter (with the same `q` and filters) returns the following page.
+    """
+    params = {"q": q, "limit": limit}
+
+    if movie_id is not None:
+        params["movie_id"] = movie_id
+
+    if character_id is not None:
+        params["character_id"] = character_id
+
+    variant = None
+    if cursor is not None:
+        (params["after_key"],), params["after_id"] = pagination.decode_cursor(
+            cursor, "rank", 1
+        )
+        if not isinstance(params["after_key"], (int, float)):
+            raise HTTPException(status_code=400, detail="invalid cursor.")
+        variant = "key"
+
+    async with db.connect() as conn:
+        stmt = search_lines_statements[
+            movie_id is not None, character_id is not None, variant
+        ]
+        result = await conn.execute(stmt, [params])
+        columns, rows = result.keys(), result.all()
+
+    response = responses.rows_response(columns, rows, line_search_keys)
+    pagination.set_next_cursor(
+        response, rows, limit,
+        lambda row: pagination.encode_cursor("rank", [row.rank], row.line_id),
+    )
+    return response
+
+
+line_stmt = sqlalchemy.text("""
+SELECT line_id, movies.title AS title, conversation_id, characters.name AS name, 
+    line_text 
+FROM lines 
+JOIN movies ON movies.movie_id = lines.movie_id 
+JOIN characters ON characters.character_id = lines.character_id 
+WHERE lines.line_id = :line_id
+""")
+
+
 @router.get("/lines/{line_id}", tags=["lines"])
-def get_lines(line_id: int):
+@cache.cached("line", "line_id")
+async def get_lines(line_id: int):
     """
     This endpoint returns a single line by its identifier. For each line it returns:
     * `line_id`: the internal id of the line.
@@ -17,30 +232,22 @@ def get_lines(line_id: int):
     * `line_text`: the line text.
 
     """
-    line_txt = """
-    SELECT line_id, movies.title AS title, conversation_id, characters.name AS name, line_text 
-    FROM lines 
-    JOIN movies ON movies.movie_id = lines.movie_id 
-    JOIN characters ON characters.character_id = lines.character_id 
-    WHERE lines.line_id = :line_id
-    """
+    if snapshot.current is not None:
+        found = snapshot.current.get_line(line_id)
+        if found is None:
+            raise HTTPException(status_code=404, detail="line not found.")
+        return line_json(found)
 
     result = None
 
-    with db.engine.connect() as conn:
-        line = conn.execute(
-            sqlalchemy.text(line_txt),
+    async with db.connect() as conn:
+        rows = await conn.execute(
+            line_stmt,
             [{"line_id": line_id}]
         )
 
-        for l in line:
-            result = {
-                "line_id": l.line_id,
-                "movie_title": l.title,
-                "conversation_id": l.conversation_id,
-                "character": l.name,
-                "line_text": l.line_text
-            }
+        for line in rows:
+            result = line_json(line)
 
         if result is None:
             raise HTTPException(status_code=404, detail="line not found.")
@@ -53,13 +260,107 @@ class line_sort_options(str, Enum):
     conversation_id = "conversation_id"
 
 
+# column label -> response key for list_lines
+line_list_keys = {
+    "line_id": "line_id",
+    "conversation_id": "conversation_id",
+    "movie_id": "movie_id",
+    "character1_name": "character1_name",
+    "character2_name": "character2_name",
+}
+
+
+line_sort_columns = {
+    line_sort_options.line_id: (db.lines.c.line_id, False),
+    line_sort_options.movie_id: (db.lines.c.movie_id, False),
+    line_sort_options.conversation_id: (db.lines.c.conversation_id, True),
+}
+
+
+c1 = db.characters.alias("c1")
+c2 = db.characters.alias("c2")
+
+
+def lines_rows(by_movie, by_conversation, *columns):
+    """The lines list_lines can return, before sorting and paging."""
+    stmt = (
+        sqlalchemy.select(*columns)
+        .join(
+            db.conversations,
+            db.lines.c.conversation_id == db.conversations.c.conversation_id,
+        )
+        .join(c1, c1.c.character_id == db.conversations.c.character1_id)
+        .join(c2, c2.c.character_id == db.conversations.c.character2_id)
+    )
+
+    if by_movie:
+        stmt = stmt.where(db.lines.c.movie_id == sqlalchemy.bindparam("movie_id"))
+
+    if by_conversation:
+        stmt = stmt.where(
+            db.conversations.c.conversation_id
+            == sqlalchemy.bindparam("conversation_id")
+        )
+    return stmt
+
+
+def list_lines_statement(sort, by_movie, by_conversation, variant):
+    sort_column, descending = line_sort_columns[sort]
+    order_by = sqlalchemy.desc(sort_column) if descending else sort_column
+
+    stmt = (
+        lines_rows(
+            by_movie, by_conversation,
+            db.lines.c.line_id,
+            db.lines.c.conversation_id,
+            db.lines.c.movie_id,
+            c1.c.name.label("character1_name"),
+            c2.c.name.label("character2_name"),
+        )
+        .limit(sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer))
+        .offset(sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer))
+        .order_by(order_by, db.lines.c.line_id)
+    )
+
+    if variant is not None:
+        stmt = stmt.where(
+            pagination.after_bound(sort_column, db.lines.c.line_id, variant, descending)
+        )
+    return stmt
+
+
+# Every variant is built once, so requests skip statement construction and
+# hit SQLAlchemy's compiled cache and the driver's prepared statements.
+list_lines_statements = {
+    (sort, by_movie, by_conversation, variant): list_lines_statement(
+        sort, by_movie, by_conversation, variant
+    )
+    for sort in line_sort_options
+    for by_movie in (False, True)
+    for by_conversation in (False, True)
+    for variant in pagination.CURSOR_VARIANTS
+}
+
+
+lines_counters = {
+    (by_movie, by_conversation): totals.Counter(
+        totals.rows_sql(lines_rows(by_movie, by_conversation, db.lines.c.line_id)),
+        table="lines" if not (by_movie or by_conversation) else None,
+    )
+    for by_movie in (False, True)
+    for by_conversation in (False, True)
+}
+
+
 @router.get("/lines/", tags=["lines"])
-def list_lines(
+async def list_lines(
     movie_id: int = None,
     conversation_id: int = None,
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: line_sort_options = line_sort_options.line_id,
+    cursor: str = None,
+    include_total: totals.total_options = None,
 ):
     """
     This endpoint returns a list of all the conversations. For each conversation it returns:
@@ -83,63 +384,88 @@ def list_lines(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
-    """
 
-    if sort == line_sort_options.line_id:
-        order_by = db.lines.c.line_id
-    elif sort == line_sort_options.movie_id:
-        order_by = db.lines.c.movie_id
-    elif sort == line_sort_options.conversation_id:
-        order_by = sqlalchemy.desc(db.lines.c.conversation_id)
-    else:
-        assert False
+    When a page is full, the `X-Next-Cursor` response header holds a cursor.
+    Passing it back as the `cursor` query parameter (with the same filters and
+    `sort`) returns the following page without re-reading the skipped rows.
 
-    c1 = db.characters.alias("c1")
-    c2 = db.characters.alias("c2")
+    `include_total=exact` adds an `X-Total-Count` header with the number of
+    lines matching the filters; `include_total=approximate` adds an
+    `X-Total-Count-Estimate` header with the planner's estimate instead. A
+    `movie_id` or `conversation_id` filter is always counted exactly.
+    """
 
-    stmt = (
-        sqlalchemy.select(
-            db.lines.c.line_id,
-            db.lines.c.conversation_id,
-            db.lines.c.movie_id,
-            c1.c.name.label("character1_name"),
-            c2.c.name.label("character2_name")
-        )
-        .join(db.conversations, db.lines.c.conversation_id == db.conversations.c.conversation_id)
-        .join(c1, c1.c.character_id == db.conversations.c.character1_id)
-        .join(c2, c2.c.character_id == db.conversations.c.character2_id)
-        .limit(limit)
-        .offset(offset)
-        .order_by(order_by, db.lines.c.line_id)
-    )
+    sort_column, descending = line_sort_columns[sort]
+    params = {"limit": limit, "offset": offset}
 
     if movie_id is not None:
-        stmt = stmt.where(db.lines.c.movie_id == movie_id)
+        params["movie_id"] = movie_id
 
     if conversation_id is not None:
-        stmt = stmt.where(db.conversations.c.conversation_id == conversation_id)
-
-
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "line_id": row.line_id,
-                    "conversation_id": row.conversation_id,
-                    "movie_id": row.movie_id,
-                    "character1_name": row.character1_name,
-                    "character2_name": row.character2_name,
-
-                }
-            )
+        params["conversation_id"] = conversation_id
+
+    after_cursor = None
+    variant = None
+    if cursor is not None:
+        after_cursor = pagination.decode_cursor(cursor, sort.value, 1)
+        (key,), params["after_id"] = after_cursor
+        variant = pagination.cursor_variant([key])
+        if key is not None:
+            params["after_key"] = key
 
-    return json
+    if snapshot.current is not None:
+        columns = list(line_list_keys)
+        rows = snapshot.current.list_lines(
+            movie_id, conversation_id, limit, offset, sort.value, after_cursor
+        )
+    else:
+        async with db.connect() as conn:
+            stmt = list_lines_statements[
+                sort, movie_id is not None, conversation_id is not None, variant
+            ]
+            result = await conn.execute(stmt, [params])
+            columns, rows = result.keys(), result.all()
+
+    response = responses.rows_response(columns, rows, line_list_keys)
+    pagination.set_next_cursor(
+        response, rows, limit,
+        lambda row: pagination.encode_cursor(
+            sort.value, [getattr(row, sort_column.name)], row.line_id
+        ),
+    )
+    filters = {
+        key: value
+        for key, value in (("movie_id", movie_id), ("conversation_id", conversation_id))
+        if value is not None
+    }
+    await totals.set_total(
+        response, include_total,
+        lines_counters[movie_id is not None, conversation_id is not None],
+        ("lines", movie_id, conversation_id), filters, selective=bool(filters),
+    )
+    return response
     
 
+# The conversation row lists its line ids in line_sort order, so the
+# transcript is one primary-key fetch per line in array order rather than a
+# scan and sort of the conversation's lines.
+conversation_lines_stmt = sqlalchemy.text("""
+SELECT lines.line_id AS line_id, lines.conversation_id AS conversation_id, 
+    movies.movie_id AS movie_id, 
+    line_sort, characters.name AS name, line_text 
+FROM conversations AS conv 
+CROSS JOIN LATERAL unnest(conv.line_ids) WITH ORDINALITY AS ids (line_id, position) 
+JOIN lines ON lines.line_id = ids.line_id 
+JOIN movies ON movies.movie_id = lines.movie_id 
+JOIN characters ON characters.character_id = lines.character_id 
+WHERE conv.conversation_id = :id 
+ORDER BY ids.position
+""")
+
+
 @router.get("/line-sort/{conv_id}", tags=["lines"])
-def sort_conv_lines(conv_id: int):
+@cache.cached("conversation", "conv_id")
+async def sort_conv_lines(conv_id: int):
     """
     This endpoint returns all the line_text in a conversation in the order spoken. For each line it returns:
     * `line_id`: the internal id of the line.
@@ -149,37 +475,92 @@ def sort_conv_lines(conv_id: int):
     * `character`: character name that says the line.
     * `line_text`: the line text.
     """
-
-    conv_txt = """
-    SELECT line_id, conversation_id, movies.movie_id AS movie_id, line_sort, characters.name AS name, line_text 
-    FROM lines 
-    JOIN movies ON movies.movie_id = lines.movie_id 
-    JOIN characters ON characters.character_id = lines.character_id 
-    WHERE lines.conversation_id = :id 
-    ORDER BY line_sort ASC
-    """
+    if snapshot.current is not None:
+        return [
+            conv_line_json(c)
+            for c in snapshot.current.conversation_lines_sorted(conv_id)
+        ]
 
     result = None
 
-    with db.engine.connect() as conn:
-        conv = conn.execute(
-            sqlalchemy.text(conv_txt),
+    async with db.connect() as conn:
+        conv = await conn.execute(
+            conversation_lines_stmt,
             [{"id": conv_id}]
         )
 
-        result = (
-            {
-                "line_id": c.line_id,
-                "conversation_id": c.conversation_id,
-                "movie_id":  c.movie_id,
-                "line_sort": c.line_sort,
-                "character": c.name,
-                "line_text": c.line_text
-            }
-            for c in conv
-        )
+        result = [conv_line_json(c) for c in conv]
 
         if result is None:
             raise HTTPException(status_code=404, detail="conversation not found.")
         
-        return result
\ No newline at end of file
+        return result
+
+
+export_txt = """
+SELECT line_id, conversation_id, lines.movie_id AS movie_id, line_sort, 
+    characters.name AS name, line_text 
+FROM lines 
+JOIN characters ON characters.character_id = lines.character_id 
+"""
+
+export_movie_stmt = sqlalchemy.text(export_txt + """
+WHERE lines.movie_id = :movie_id 
+ORDER BY conversation_id ASC, line_sort ASC
+""")
+
+export_all_stmt = sqlalchemy.text(export_txt + """
+ORDER BY line_id ASC
+""")
+
+movie_exists_stmt = sqlalchemy.text("SELECT 1 FROM movies WHERE movie_id = :movie_id")
+
+
+# column label -> response key for the exports, the /line-sort/ shape
+export_keys = {
+    "line_id": "line_id",
+    "conversation_id": "conversation_id",
+    "movie_id": "movie_id",
+    "line_sort": "line_sort",
+    "name": "character",
+    "line_text": "line_text",
+}
+
+
+async def export_lines(stmt, params):
+    columns = list(export_keys)
+    async with db.connect() as conn:
+        async for rows in db.stream(conn, stmt, params):
+            yield responses.ndjson_rows(columns, rows, export_keys)
+
+
+@router.get("/movies/{movie_id}/lines.ndjson", tags=["lines"])
+async def export_movie_lines(movie_id: int):
+    """
+    This endpoint streams every line of a movie as newline-delimited JSON, one
+    line object per row in the same shape as `/line-sort/{conv_id}`, ordered by
+    conversation and then by the order spoken.
+    """
+    async with db.connect() as conn:
+        movie = await conn.execute(
+            movie_exists_stmt,
+            [{"movie_id": movie_id}]
+        )
+        if movie.first() is None:
+            raise HTTPException(status_code=404, detail="movie not found.")
+
+    return StreamingResponse(
+        export_lines(export_movie_stmt, {"movie_id": movie_id}),
+        media_type="application/x-ndjson",
+    )
+
+
+@router.get("/lines.ndjson", tags=["lines"])
+async def export_all_lines():
+    """
+    This endpoint streams every line in the database as newline-delimited JSON,
+    in the same shape as `/line-sort/{conv_id}`, ordered by `line_id`.
+    """
+    return StreamingResponse(
+        export_lines(export_all_stmt, {}), media_type="application/x-ndjson"
+    )
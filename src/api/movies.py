@@ -1,14 +1,120 @@
 from fastapi import APIRouter, HTTPException
 from enum import Enum
+from src import cache, graph, snapshot
 from src import database as db
+from src.api import pagination, responses, totals
+from src.api.params import parse_ids
 from fastapi.params import Query
+import orjson
 import sqlalchemy
 
 router = APIRouter()
 
 
+def movie_json(row, top_chars):
+    return {
+        "movie_id": row.movie_id,
+        "title": row.title,
+        "top_characters": [
+            {"character_id": c.id, "character": c.name, "num_lines": c.num_lines}
+            for c in top_chars
+        ],
+    }
+
+
+movies_batch_stmt = sqlalchemy.text("""
+SELECT movie_id, title 
+FROM movies 
+WHERE movies.movie_id = ANY(:ids)
+""")
+
+# top five characters of each movie
+top_characters_batch_stmt = sqlalchemy.text("""
+SELECT movie_id, id, name, num_lines 
+FROM (
+    SELECT c.movie_id, c.character_id AS id, c.name AS name, c.num_lines AS num_lines, 
+        ROW_NUMBER() OVER (
+            PARTITION BY c.movie_id ORDER BY c.num_lines DESC, c.character_id ASC
+        ) AS rank 
+    FROM characters AS c 
+    WHERE c.movie_id = ANY(:ids) AND c.num_lines > 0
+) AS ranked 
+WHERE rank <= 5 
+ORDER BY movie_id, rank
+""")
+
+
+@router.get("/movies:batch", tags=["movies"])
+async def get_movies(ids: str):
+    """
+    This endpoint returns many movies at once. `ids` is a comma-separated list
+    of up to 250 movie ids, e.g. `?ids=44,436`.
+
+    It returns:
+    * `results`: an object keyed by movie id whose values have the same shape
+      as `/movies/{movie_id}`.
+    * `missing`: the requested ids that do not exist.
+    """
+    ids = parse_ids(ids)
+
+    async with db.connect() as conn:
+        result = await conn.execute(movies_batch_stmt, [{"ids": ids}])
+        result_2 = await conn.execute(top_characters_batch_stmt, [{"ids": ids}])
+
+    chars_by_movie = {}
+    for c in result_2:
+        chars_by_movie.setdefault(c.movie_id, []).append(c)
+
+    results = {
+        row.movie_id: movie_json(row, chars_by_movie.get(row.movie_id, []))
+        for row in result
+    }
+
+    return {
+        "results": results,
+        "missing": [id for id in ids if id not in results],
+    }
+
+
+def ranked_characters_txt(fields, limit=None):
+    """
+    Lateral subquery aggregating a movie's characters with lines, most lines
+    first, into a JSON array in the response's shape. `fields` maps response
+    keys to characters columns. The ordering is the one
+    characters_movie_num_lines_idx provides, so `limit` stops the index scan.
+    """
+    pairs = ", ".join(f"'{key}', t.{column}" for key, column in fields.items())
+    return f"""
+    SELECT json_agg(
+        json_build_object({pairs}) ORDER BY t.num_lines DESC, t.character_id ASC
+    ) AS characters 
+    FROM (
+        SELECT c.character_id, c.name, c.gender, c.num_lines, c.num_words 
+        FROM characters AS c 
+        WHERE c.movie_id = movies.movie_id AND c.num_lines > 0 
+        ORDER BY c.num_lines DESC, c.character_id ASC 
+        {"" if limit is None else f"LIMIT {int(limit)}"}
+    ) AS t
+    """
+
+
+# One round trip: the top characters are aggregated into a JSON array
+# next to the movie row, already in the response's shape.
+movie_stmt = sqlalchemy.text(f"""
+SELECT movies.movie_id, movies.title, 
+    CAST(COALESCE(top.characters, '[]') AS text) AS top_characters 
+FROM movies 
+CROSS JOIN LATERAL ({ranked_characters_txt(
+    {"character_id": "character_id", "character": "name", "num_lines": "num_lines"},
+    limit=5,
+)}) AS top 
+WHERE movies.movie_id = :movie_id
+""")
+
+
 @router.get("/movies/{movie_id}", tags=["movies"])
-def get_movie(movie_id: int):
+@cache.cached("movie", "movie_id")
+async def get_movie(movie_id: int):
     """
     This endpoint returns a single movie by its identifier. For each movie it returns:
     * `movie_id`: the internal id of the movie.
@@ -23,43 +129,160 @@ def get_movie(movie_id: int):
     * `num_lines`: The number of lines the character has in the movie.
 
     """
-    # get movie
-    txt = """
-    SELECT movie_id, title 
-    FROM movies 
-    WHERE movies.movie_id = :movie_id
+    if snapshot.current is not None:
+        found = snapshot.current.get_movie(movie_id)
+        if found is None:
+            raise HTTPException(status_code=404, detail="movie not found.")
+        return movie_json(*found)
+
+    async with db.connect() as conn:
+        result = await conn.execute(movie_stmt, [{"movie_id": movie_id}])
+        row = result.first()
+
+    if row is None:
+        raise HTTPException(status_code=404, detail="movie not found.")
+
+    return {
+        "movie_id": row.movie_id,
+        "title": row.title,
+        "top_characters": orjson.loads(row.top_characters),
+    }
+
+# Everything comes from the counts add_conversation maintains: the movie row,
+# its characters and gender counts by primary-key prefix, and its longest
+# conversations from conversations_movie_num_lines_idx. No lines are read.
+movie_stats_stmt = sqlalchemy.text(f"""
+SELECT movies.movie_id, movies.title, movies.num_conversations, movies.num_lines, 
+    movies.num_words, 
+    CAST(COALESCE(chars.characters, '[]') AS text) AS characters, 
+    CAST(COALESCE(genders.lines_by_gender, '{{}}') AS text) AS lines_by_gender, 
+    CAST(COALESCE(longest.conversations, '[]') AS text) AS longest_conversations 
+FROM movies 
+CROSS JOIN LATERAL ({ranked_characters_txt({
+    "character_id": "character_id", "character": "name", "gender": "gender",
+    "num_lines": "num_lines", "num_words": "num_words",
+})}) AS chars 
+CROSS JOIN LATERAL (
+    SELECT json_object_agg(g.gender, g.num_lines ORDER BY g.gender) AS lines_by_gender 
+    FROM movie_gender_lines AS g 
+    WHERE g.movie_id = movies.movie_id AND g.num_lines > 0
+) AS genders 
+CROSS JOIN LATERAL (
+    SELECT json_agg(
+        json_build_object(
+            'conversation_id', t.conversation_id, 'character_1_id', t.character1_id, 
+            'character_2_id', t.character2_id, 'num_lines', t.num_lines
+        ) ORDER BY t.num_lines DESC, t.conversation_id ASC
+    ) AS conversations 
+    FROM (
+        SELECT conv.conversation_id, conv.character1_id, conv.character2_id, 
+            conv.num_lines 
+        FROM conversations AS conv 
+        WHERE conv.movie_id = movies.movie_id 
+        ORDER BY conv.num_lines DESC, conv.conversation_id ASC 
+        LIMIT :longest
+    ) AS t
+) AS longest 
+WHERE movies.movie_id = :movie_id
+""")
+
+
+@router.get("/movies/{movie_id}/stats", tags=["movies"])
+@cache.cached("movie_stats", "movie_id")
+async def get_movie_stats(movie_id: int, longest: int = Query(5, ge=1, le=50)):
     """
+    This endpoint returns dialogue statistics for a single movie:
+    * `movie_id`: the internal id of the movie.
+    * `title`: The title of the movie.
+    * `num_conversations`: The number of conversations in the movie.
+    * `num_lines`: The number of lines spoken in the movie.
+    * `num_words`: The number of words spoken in the movie.
+    * `lines_by_gender`: An object mapping each speaker gender to the number
+      of lines spoken by characters of that gender. Characters without a
+      gender are counted under `?`.
+    * `characters`: Every character with at least one line, ordered by the
+      number of lines they have. The first five are the movie's
+      `top_characters`.
+    * `longest_conversations`: The `longest` conversations (five by default)
+      with the most lines, longest first.
 
-    # top characters 
-    txt_2 = """
-    SELECT c.character_id AS id, c.name AS name, COUNT(*) num_lines
-    FROM characters AS c 
-    JOIN lines ON c.character_id = lines.character_id
-    WHERE c.movie_id = :movie_id
-    GROUP BY c.character_id
-    ORDER BY num_lines DESC
-    LIMIT 5
+    Each character is represented by a dictionary with the following keys:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `gender`: The gender of the character.
+    * `num_lines`: The number of lines the character has in the movie.
+    * `num_words`: The number of words in those lines.
+
+    Each conversation is represented by a dictionary with the following keys:
+    * `conversation_id`: the internal id of the conversation.
+    * `character_1_id`: the id of the first character in the conversation.
+    * `character_2_id`: the id of the second character in the conversation.
+    * `num_lines`: The number of lines in the conversation.
     """
+    async with db.connect() as conn:
+        result = await conn.execute(
+            movie_stats_stmt, [{"movie_id": movie_id, "longest": longest}]
+        )
+        row = result.first()
 
-    with db.engine.connect() as conn:
-        result = conn.execute(sqlalchemy.text(txt), [{"movie_id": movie_id}])   # movie info
-        result_2 = conn.execute(sqlalchemy.text(txt_2), [{"movie_id": movie_id}])   # top chars info
+    if row is None:
+        raise HTTPException(status_code=404, detail="movie not found.")
 
-        movie_res = None
+    return {
+        "movie_id": row.movie_id,
+        "title": row.title,
+        "num_conversations": row.num_conversations,
+        "num_lines": row.num_lines,
+        "num_words": row.num_words,
+        "lines_by_gender": orjson.loads(row.lines_by_gender),
+        "characters": orjson.loads(row.characters),
+        "longest_conversations": orjson.loads(row.longest_conversations),
+    }
 
-        for row in result:
-            top_chars = [{"character_id": c.id, "character": c.name, "num_lines": c.num_lines} for c in result_2]
-            
-            movie_res = {
-                "movie_id": movie_id, 
-                "title": row.title, 
-                "top_characters": top_chars,
-            }
 
-        if movie_res is None:
-            raise HTTPException(status_code=404, detail="movie not found.")
+@router.get("/movies/{movie_id}/centrality", tags=["movies"])
+async def get_movie_centrality(movie_id: int):
+    """
+    This endpoint ranks the characters of a movie by how central they are to
+    its dialogue. Two characters are connected if they have a conversation.
+    For each character it returns:
+    * `character_id`: the internal id of the character.
+    * `character`: The name of the character.
+    * `partners`: The number of characters they have conversations with.
+    * `lines`: The number of lines in those conversations.
+    * `closeness`: How few conversation links separate them from everyone
+      they can reach, between 0 and 1.
+    * `betweenness`: The share of shortest links between two other
+      characters that pass through them, between 0 and 1.
+
+    The characters are ordered by `betweenness`, then `closeness`, then
+    `lines`.
+    """
+    g = await graph.get()
+    if movie_id not in g.movie_nodes:
+        raise HTTPException(status_code=404, detail="movie not found.")
+
+    ranked = sorted(
+        g.centrality(movie_id).items(),
+        key=lambda item: (
+            -item[1][3],
+            -item[1][2],
+            -item[1][1],
+            g.character_ids[item[0]],
+        ),
+    )
+    return [
+        {
+            "character_id": g.character_ids[node],
+            "character": g.names[node],
+            "partners": partners,
+            "lines": lines,
+            "closeness": round(closeness, 6),
+            "betweenness": round(betweenness, 6),
+        }
+        for node, (partners, lines, closeness, betweenness) in ranked
+    ]
 
-        return movie_res
 
 class movie_sort_options(str, Enum):
     movie_title = "movie_title"
@@ -67,13 +290,82 @@ class movie_sort_options(str, Enum):
     rating = "rating"
 
 
+# column label -> response key for list_movies
+movie_list_keys = {
+    "movie_id": "movie_id",
+    "title": "movie_title",
+    "year": "year",
+    "imdb_rating": "imdb_rating",
+    "imdb_votes": "imdb_votes",
+}
+
+
+movie_sort_columns = {
+    movie_sort_options.movie_title: (db.movies.c.title, False),
+    movie_sort_options.year: (db.movies.c.year, False),
+    movie_sort_options.rating: (db.movies.c.imdb_rating, True),
+}
+
+
+def list_movies_statement(sort, by_name, variant):
+    sort_column, descending = movie_sort_columns[sort]
+    order_by = sqlalchemy.desc(sort_column) if descending else sort_column
+
+    stmt = (
+        sqlalchemy.select(
+            db.movies.c.movie_id,
+            db.movies.c.title,
+            db.movies.c.year,
+            db.movies.c.imdb_rating,
+            db.movies.c.imdb_votes,
+        )
+        .limit(sqlalchemy.bindparam("limit", type_=sqlalchemy.Integer))
+        .offset(sqlalchemy.bindparam("offset", type_=sqlalchemy.Integer))
+        .order_by(order_by, db.movies.c.movie_id)
+    )
+
+    # filter only if name parameter is passed
+    if by_name:
+        stmt = stmt.where(db.movies.c.title.ilike(sqlalchemy.bindparam("name")))
+
+    if variant is not None:
+        stmt = stmt.where(
+            pagination.after_bound(
+                sort_column, db.movies.c.movie_id, variant, descending
+            )
+        )
+    return stmt
+
+
+# Every variant is built once, so requests skip statement construction and
+# hit SQLAlchemy's compiled cache and the driver's prepared statements.
+list_movies_statements = {
+    (sort, by_name, variant): list_movies_statement(sort, by_name, variant)
+    for sort in movie_sort_options
+    for by_name in (False, True)
+    for variant in pagination.CURSOR_VARIANTS
+}
+
+
+def movies_counter(by_name):
+    stmt = sqlalchemy.select(db.movies.c.movie_id)
+    if by_name:
+        stmt = stmt.where(db.movies.c.title.ilike(sqlalchemy.bindparam("name")))
+    return totals.Counter(totals.rows_sql(stmt), table=None if by_name else "movies")
+
+
+movies_counters = {by_name: movies_counter(by_name) for by_name in (False, True)}
+
+
 # Add get parameters
 @router.get("/movies/", tags=["movies"])
-def list_movies(
+async def list_movies(
     name: str = "",
     limit: int = Query(50, ge=1, le=250),
     offset: int = Query(0, ge=0),
     sort: movie_sort_options = movie_sort_options.movie_title,
+    cursor: str = None,
+    include_total: totals.total_options = None,
 ):
     """
     This endpoint returns a list of movies. For each movie it returns:
@@ -96,45 +388,50 @@ def list_movies(
     parameters are used for pagination. The `limit` query parameter specifies the
     maximum number of results to return. The `offset` query parameter specifies the
     number of results to skip before returning results.
-    """
-    if sort is movie_sort_options.movie_title:
-        order_by = db.movies.c.title
-    elif sort is movie_sort_options.year:
-        order_by = db.movies.c.year
-    elif sort is movie_sort_options.rating:
-        order_by = sqlalchemy.desc(db.movies.c.imdb_rating)
-    else:
-        assert False
 
-    stmt = (
-        sqlalchemy.select(
-            db.movies.c.movie_id,
-            db.movies.c.title,
-            db.movies.c.year,
-            db.movies.c.imdb_rating,
-            db.movies.c.imdb_votes,
-        )
-        .limit(limit)
-        .offset(offset)
-        .order_by(order_by, db.movies.c.movie_id)
-    )
+    When a page is full, the `X-Next-Cursor` response header holds a cursor.
+    Passing it back as the `cursor` query parameter (with the same `name` and
+    `sort`) returns the following page without re-reading the skipped rows.
+
+    `include_total=exact` adds an `X-Total-Count` header with the number of
+    movies matching `name`; `include_total=approximate` adds an
+    `X-Total-Count-Estimate` header with the planner's estimate instead.
+    """
+    sort_column, descending = movie_sort_columns[sort]
+    params = {"limit": limit, "offset": offset}
 
-    # filter only if name parameter is passed
     if name != "":
-        stmt = stmt.where(db.movies.c.title.ilike(f"%{name}%"))
-
-    with db.engine.connect() as conn:
-        result = conn.execute(stmt)
-        json = []
-        for row in result:
-            json.append(
-                {
-                    "movie_id": row.movie_id,
-                    "movie_title": row.title,
-                    "year": row.year,
-                    "imdb_rating": row.imdb_rating,
-                    "imdb_votes": row.imdb_votes,
-                }
-            )
+        params["name"] = db.contains_pattern(name)
 
-    return json
+    after_cursor = None
+    variant = None
+    if cursor is not None:
+        after_cursor = pagination.decode_cursor(cursor, sort.value, 1)
+        (key,), params["after_id"] = after_cursor
+        variant = pagination.cursor_variant([key])
+        if key is not None:
+            params["after_key"] = key
+
+    if snapshot.current is not None:
+        columns = list(movie_list_keys)
+        rows = snapshot.current.list_movies(
+            name, limit, offset, sort.value, after_cursor
+        )
+    else:
+        async with db.connect() as conn:
+            stmt = list_movies_statements[sort, name != "", variant]
+            result = await conn.execute(stmt, [params])
+            columns, rows = result.keys(), result.all()
+
+    response = responses.rows_response(columns, rows, movie_list_keys)
+    pagination.set_next_cursor(
+        response, rows, limit,
+        lambda row: pagination.encode_cursor(
+            sort.value, [getattr(row, sort_column.name)], row.movie_id
+        ),
+    )
+    await totals.set_total(
+        response, include_total, movies_counters[name != ""],
+        ("movies", name), {"name": params["name"]} if name != "" else {},
+    )
+    return response
@@ -0,0 +1,78 @@
+import base64
+import json
+
+import sqlalchemy
+from fastapi import HTTPException
+
+# Keyset pagination: a cursor remembers the sort key and id of the last row on
+# a page, so the next page starts with a range condition instead of OFFSET.
+
+
+def encode_cursor(sort: str, keys: list, id: int) -> str:
+    payload = json.dumps({"s": sort, "k": keys, "id": id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, num_keys: int):
+    """Returns (keys, id) or raises a 400 if the cursor is malformed or was
+    issued for a different sort order."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        keys, id = payload["k"], payload["id"]
+        valid = payload["s"] == sort and len(keys) == num_keys and isinstance(id, int)
+    except (ValueError, TypeError, KeyError):
+        valid = False
+
+    if not valid:
+        raise HTTPException(status_code=400, detail="invalid cursor.")
+
+    return keys, id
+
+
+def after(column, key, id_column, id, descending=False):
+    """
+    Condition selecting rows that come after (key, id) when ordered by
+    `column` (ASC NULLS LAST, or DESC NULLS FIRST as Postgres does by default)
+    and then `id_column` ascending.
+    """
+    if descending:
+        if key is None:
+            return sqlalchemy.or_(
+                column.is_not(None),
+                sqlalchemy.and_(column.is_(None), id_column > id),
+            )
+        return sqlalchemy.or_(
+            column < key,
+            sqlalchemy.and_(column == key, id_column > id),
+        )
+
+    if key is None:
+        return sqlalchemy.and_(column.is_(None), id_column > id)
+    return sqlalchemy.or_(
+        column > key,
+        sqlalchemy.and_(column == key, id_column > id),
+        column.is_(None),
+    )
+
+
+# Statements built once at import have one variant per form of the `after`
+# condition: no cursor, a cursor whose key is NULL, or one with a key.
+CURSOR_VARIANTS = (None, "null", "key")
+
+
+def cursor_variant(keys):
+    return "null" if keys[0] is None else "key"
+
+
+def after_bound(column, id_column, variant, descending=False):
+    """`after` for the given cursor variant, with :after_key and :after_id
+    left as bound parameters."""
+    key = None if variant == "null" else sqlalchemy.bindparam("after_key")
+    return after(column, key, id_column, sqlalchemy.bindparam("after_id"), descending)
+
+
+def set_next_cursor(response, rows, limit, cursor_for):
+    """A full page means there may be more, so hand out a cursor for it."""
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = cursor_for(rows[-1])
@@ -0,0 +1,23 @@
+from typing import List
+
+from fastapi import HTTPException
+
+
+def parse_ids(ids: str, max_ids: int = 250) -> List[int]:
+    """Parses a comma-separated `ids` query parameter such as `1,2,3`."""
+    try:
+        parsed = [int(id) for id in ids.split(",") if id.strip() != ""]
+    except ValueError:
+        raise HTTPException(
+            status_code=422, detail="ids must be comma-separated integers."
+        )
+
+    if not parsed:
+        raise HTTPException(status_code=422, detail="ids must not be empty.")
+    if len(parsed) > max_ids:
+        raise HTTPException(
+            status_code=422, detail=f"at most {max_ids} ids per request."
+        )
+
+    # duplicates resolve to the same result
+    return list(dict.fromkeys(parsed))
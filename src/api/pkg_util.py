@@ -1,8 +1,11 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 import os
 import pkg_resources
 import sys
 
+from src import cache, metrics, slow_queries
+
 router = APIRouter()
 
 # This file is purely for debugging purposes. You can ignore.
@@ -44,3 +47,22 @@ def get_pkgsize():
 
     message = sorted(message, key=lambda d: d["size_in_mb"], reverse=True)
     return {"message": message}
+
+
+@router.get("/cachestats/")
+def get_cache_stats():
+    return cache.detail_cache.stats()
+
+
+@router.get("/metrics/", response_class=PlainTextResponse)
+def get_metrics():
+    """Per-route latency and query-count histograms for Prometheus."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@router.get("/slowqueries/")
+def get_slow_queries():
+    """Recent statements slower than SLOW_QUERY_MS, newest first."""
+    return slow_queries.recent()
@@ -1,5 +1,11 @@
-from fastapi import FastAPI
-from src.api import characters, movies, lines, conversations, pkg_util
+import asyncio
+import os
+
+from fastapi import FastAPI, Request, Response
+from starlette.concurrency import run_in_threadpool
+from src import cache, metrics, snapshot
+from src import database as db
+from src.api import characters, movies, lines, conversations, pkg_util, responses
 
 description = """
 Movie API returns dialog statistics on top hollywood movies from decades past.
@@ -40,6 +46,7 @@ app = FastAPI(
         "email": "vguzma08@calpoly.edu",
     },
     openapi_tags=tags_metadata,
+    default_response_class=responses.JSONResponse,
 )
 app.include_router(characters.router)
 app.include_router(movies.router)
@@ -48,6 +55,84 @@ app.include_router(pkg_util.router)
 app.include_router(conversations.router)
 
 
+@app.on_event("startup")
+async def check_schema():
+    # Off by default: it costs a few round trips on every cold start.
+    if db.env_flag("DB_SCHEMA_CHECK"):
+        await run_in_threadpool(db.check_schema)
+
+
+@app.on_event("startup")
+async def load_snapshot():
+    # Loaded in the background; requests are served from Postgres meanwhile.
+    if snapshot.ENABLED:
+        app.state.snapshot_load = asyncio.create_task(snapshot.load())
+
+
+@app.on_event("startup")
+async def start_write_queue():
+    if conversations.QUEUE_ENABLED:
+        conversations.start_writer()
+
+
+@app.on_event("shutdown")
+async def stop_write_queue():
+    await conversations.stop_writer()
+
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to the Movie API. See /docs for more information."}
+
+
+# Read endpoints whose responses only change when the data version does.
+VERSIONED_PATHS = ("/characters", "/movies", "/lines", "/line-sort")
+CACHE_CONTROL = os.environ.get("CACHE_CONTROL", "no-cache")
+
+
+@app.middleware("http")
+async def conditional_get(request: Request, call_next):
+    """
+    Tags read responses with an ETag derived from the data version and the
+    request, and answers a matching If-None-Match with 304 before routing,
+    so no query runs and nothing is serialized.
+    """
+    if request.method != "GET" or not request.url.path.startswith(VERSIONED_PATHS):
+        return await call_next(request)
+
+    version = await cache.data_version.get()
+    etag = cache.etag(version, request.url.path, request.query_params.multi_items())
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    # "*" is not honored: it only matches when the resource exists, which is
+    # not known before routing
+    if_none_match = request.headers.get("if-none-match", "")
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    candidates = [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+    if etag in candidates:
+        return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+
+# Registered last so it wraps conditional_get and sees its queries too.
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    """
+    Counts the SQL statements and DB time of each request, reports them with
+    the serialization time in a Server-Timing header, and records the
+    request in the /metrics/ histograms under its route template.
+    """
+    stats = metrics.RequestStats(request.scope)
+    token = metrics.current_request.set(stats)
+    try:
+        response = await call_next(request)
+    finally:
+        metrics.current_request.reset(token)
+
+    response.headers["Server-Timing"] = stats.server_timing()
+    metrics.observe(stats)
+    return response
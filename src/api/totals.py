@@ -0,0 +1,100 @@
+import json
+import os
+from enum import Enum
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from src import cache
+from src import database as db
+
+# Optional result counts for the list endpoints, sent in a header so the
+# response bodies keep their shape:
+# * `exact` runs COUNT(*) over the filtered rows. Counts are cached per
+#   filter and data version, so paging through a result set counts it once
+#   and any write makes every count stale.
+# * `approximate` reads the planner's estimate instead (pg_class.reltuples
+#   for a whole table, otherwise the row estimate from EXPLAIN), which costs
+#   the same however many rows match.
+
+
+class total_options(str, Enum):
+    exact = "exact"
+    approximate = "approximate"
+
+
+count_cache = cache.LRUCache(
+    maxsize=int(os.environ.get("COUNT_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("COUNT_CACHE_TTL", 300)),
+)
+
+_dialect = postgresql.dialect(paramstyle="named")
+
+reltuples_stmt = sqlalchemy.text(
+    "SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"
+)
+
+
+def rows_sql(stmt) -> str:
+    """SQL of a Core select with `:name` parameters, for wrapping in text()."""
+    return str(stmt.compile(dialect=_dialect))
+
+
+class Counter:
+    """
+    Counts the rows one filter variant of a list query matches. `rows_txt`
+    selects those rows (no ORDER BY, LIMIT or cursor condition). `table` is
+    given when the unfiltered variant covers the whole table, so its
+    estimate can come straight from the table statistics.
+    """
+
+    def __init__(self, rows_txt, table=None):
+        self.count_stmt = sqlalchemy.text(
+            f"SELECT COUNT(*) FROM ({rows_txt}) AS counted"
+        )
+        self.explain_stmt = sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {rows_txt}")
+        self.table = table
+
+    async def exact(self, conn, key, params):
+        version = await cache.data_version.get()
+        cache_key = ("count", version) + key
+        hit, total = count_cache.get(cache_key)
+        if not hit:
+            generation = count_cache.generation
+            result = await conn.execute(self.count_stmt, [params])
+            total = result.scalar_one()
+            count_cache.set(cache_key, total, generation)
+        return total
+
+    async def estimate(self, conn, params):
+        if self.table is not None:
+            result = await conn.execute(reltuples_stmt, [{"table": self.table}])
+            reltuples = result.scalar_one()
+            # -1 until the table has been vacuumed or analyzed
+            if reltuples >= 0:
+                return reltuples
+
+        result = await conn.execute(self.explain_stmt, [params])
+        plan = result.scalar_one()
+        if isinstance(plan, str):  # asyncpg does not decode json
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+
+async def set_total(response, mode, counter, key, params, selective=False):
+    """
+    Adds X-Total-Count (exact) or X-Total-Count-Estimate (approximate) to
+    `response`. `key` identifies the filter values and `params` binds them.
+    A `selective` filter is one an index narrows to a few rows; those are
+    counted exactly even in approximate mode, which is as cheap and better.
+    """
+    if mode is None:
+        return
+
+    async with db.connect() as conn:
+        if mode == total_options.exact or selective:
+            total = await counter.exact(conn, key, params)
+            response.headers["X-Total-Count"] = str(total)
+        else:
+            total = await counter.estimate(conn, params)
+            response.headers["X-Total-Count-Estimate"] = str(total)
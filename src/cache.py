@@ -0,0 +1,162 @@
+import functools
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import sqlalchemy
+
+from src import database as db
+
+# In-process read-through cache for the detail endpoints. Each worker process
+# has its own copy. Entries are keyed by the data version, so a write made by
+# any process retires them as soon as this one sees the new version;
+# add_conversation also invalidates the entries its own writes touch at once.
+
+
+class LRUCache:
+    """
+    Bounded LRU cache whose entries also expire `ttl` seconds after being
+    stored. A `maxsize` of 0 disables caching.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidation so a read that started before a write
+        # cannot store what it read after the write invalidated it
+        self.generation = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._entries[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value, generation):
+        if self.maxsize <= 0 or generation != self.generation:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *ids):
+        """Drops every entry cached for any of the given (namespace, id) pairs."""
+        self.generation += 1
+        ids = set(ids)
+        for key in [key for key in self._entries if key[:2] in ids]:
+            del self._entries[key]
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+detail_cache = LRUCache(
+    maxsize=int(os.environ.get("CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("CACHE_TTL", 60)),
+)
+
+
+def cached(namespace, id_param):
+    """
+    Caches an async detail handler under (namespace, id, *other arguments,
+    data version), where the id is the handler's `id_param` argument. Errors
+    such as a 404 are not cached.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(**kwargs):
+            version = await data_version.get()
+            key = (
+                (namespace, kwargs[id_param])
+                + tuple(sorted((k, v) for k, v in kwargs.items() if k != id_param))
+                + (version,)
+            )
+            hit, value = detail_cache.get(key)
+            if hit:
+                return value
+
+            generation = detail_cache.generation
+            value = await handler(**kwargs)
+            detail_cache.set(key, value, generation)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+# A new sequence reports last_value 1 before its first nextval() also returns
+# 1, so until then the version reads as 0.
+read_version_stmt = sqlalchemy.text(
+    "SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM data_version_seq"
+)
+bump_version_stmt = sqlalchemy.text("SELECT nextval('data_version_seq')")
+
+
+class DataVersion:
+    """
+    A number that goes up after every committed write, read from the
+    data_version_seq sequence so that every process sees every other
+    process's writes. The value is re-read at most once per `ttl` seconds;
+    this process's own writes are seen at once.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.value = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+
+    async def get(self):
+        stale = time.monotonic() - self._fetched_at > self.ttl
+        if self.value is None or (stale and not self._refreshing):
+            self._refreshing = True
+            try:
+                async with db.connect() as conn:
+                    result = await conn.execute(read_version_stmt)
+                    self._set(result.scalar_one())
+            finally:
+                self._refreshing = False
+        return self.value
+
+    async def bump(self):
+        """Call after a write has committed."""
+        async with db.connect() as conn:
+            result = await conn.execute(bump_version_stmt)
+            self._set(result.scalar_one())
+
+    def _set(self, value):
+        self.value = max(value, self.value or 0)
+        self._fetched_at = time.monotonic()
+
+
+data_version = DataVersion(ttl=float(os.environ.get("DATA_VERSION_TTL", 1)))
+
+
+def etag(version, path, query_items):
+    """Strong ETag for a GET of `path` with `query_items` at `version`."""
+    query = "&".join(f"{k}={v}" for k, v in sorted(query_items))
+    digest = hashlib.sha1(f"{version}:{path}?{query}".encode()).hexdigest()
+    return f'"{digest}"'
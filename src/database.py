@@ -1,7 +1,14 @@
-import csv
+import asyncio
+import contextlib
+import io
 import os
+import threading
+import weakref
 import dotenv
 import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import create_async_engine
+from starlette.concurrency import run_in_threadpool
 
 
 # DO NOT CHANGE THIS TO BE HARDCODED. ONLY PULL FROM ENVIRONMENT VARIABLES.
@@ -13,23 +20,320 @@ def try_parse(type, val):
     except ValueError:
         return None
 
+def env_flag(name, default=False):
+    val = os.environ.get(name)
+    if val is None:
+        return default
+    return val.strip().lower() in ("1", "true", "yes", "on")
+
 ## Postgres
 
-def database_connection_url():
+def database_connection_url(driver="postgresql"):
     dotenv.load_dotenv()
     DB_USER: str = os.environ.get("POSTGRES_USER")
     DB_PASSWD = os.environ.get("POSTGRES_PASSWORD")
     DB_SERVER: str = os.environ.get("POSTGRES_SERVER")
     DB_PORT: str = os.environ.get("POSTGRES_PORT")
     DB_NAME: str = os.environ.get("POSTGRES_DB")
-    return f"postgresql://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+    return f"{driver}://{DB_USER}:{DB_PASSWD}@{DB_SERVER}:{DB_PORT}/{DB_NAME}"
+
+# Route handlers run their queries on the asyncpg engine unless DB_ASYNC=0,
+# in which case they fall back to the sync engine on the threadpool.
+ASYNC_DB = env_flag("DB_ASYNC", default=True)
 
-# Create a new DB engine based on our connection string
-engine = sqlalchemy.create_engine(database_connection_url())
+# The tables are declared rather than reflected so importing the app needs no
+# database round trips. With DB_SCHEMA_CHECK=1 the server compares them to
+# the live schema at startup (see `schema_differences`).
 metadata_obj = sqlalchemy.MetaData()
 
-movies = sqlalchemy.Table("movies", metadata_obj, autoload_with=engine)
-characters = sqlalchemy.Table("characters", metadata_obj, autoload_with=engine)
-lines = sqlalchemy.Table("lines", metadata_obj, autoload_with=engine)
-conversations = sqlalchemy.Table("conversations", metadata_obj, autoload_with=engine)
+movies = sqlalchemy.Table(
+    "movies",
+    metadata_obj,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("title", sqlalchemy.Text),
+    sqlalchemy.Column("year", sqlalchemy.Text),
+    sqlalchemy.Column("imdb_rating", sqlalchemy.Float),
+    sqlalchemy.Column("imdb_votes", sqlalchemy.Integer),
+    sqlalchemy.Column("raw_script_url", sqlalchemy.Text),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_words", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_conversations", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+characters = sqlalchemy.Table(
+    "characters",
+    metadata_obj,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.Text),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+    sqlalchemy.Column("gender", sqlalchemy.Text),
+    sqlalchemy.Column("age", sqlalchemy.Integer),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Column(
+        "num_words", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+conversations = sqlalchemy.Table(
+    "conversations",
+    metadata_obj,
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character1_id", sqlalchemy.Integer),
+    sqlalchemy.Column("character2_id", sqlalchemy.Integer),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+    # the conversation's line ids in line_sort order, kept by add_conversation
+    sqlalchemy.Column(
+        "line_ids",
+        sqlalchemy.ARRAY(sqlalchemy.Integer),
+        nullable=False,
+        server_default="{}",
+    ),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+lines = sqlalchemy.Table(
+    "lines",
+    metadata_obj,
+    sqlalchemy.Column("line_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("character_id", sqlalchemy.Integer),
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer),
+    sqlalchemy.Column("conversation_id", sqlalchemy.Integer),
+    sqlalchemy.Column("line_sort", sqlalchemy.Integer),
+    sqlalchemy.Column("line_text", sqlalchemy.Text),
+    # generated by Postgres, so every insert (add_conversation's included)
+    # keeps the search index current
+    sqlalchemy.Column(
+        "line_tsv",
+        postgresql.TSVECTOR,
+        sqlalchemy.Computed(
+            "to_tsvector('english', COALESCE(line_text, ''))", persisted=True
+        ),
+    ),
+)
+
+character_partners = sqlalchemy.Table(
+    "character_partners",
+    metadata_obj,
+    sqlalchemy.Column("character_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("partner_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "lines_together", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+# lines per speaker gender in each movie, kept by add_conversation; characters
+# without a gender count under "?"
+movie_gender_lines = sqlalchemy.Table(
+    "movie_gender_lines",
+    metadata_obj,
+    sqlalchemy.Column("movie_id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("gender", sqlalchemy.Text, primary_key=True),
+    sqlalchemy.Column(
+        "num_lines", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+)
+
+
+def _compatible(static_type, live_type):
+    # e.g. Text vs VARCHAR or Float vs NUMERIC are fine, Integer vs Text is not
+    static, live = static_type._type_affinity, live_type._type_affinity
+    return issubclass(static, live) or issubclass(live, static)
+
+
+def schema_differences(conn):
+    """
+    Compares the declared tables with the live database on a sync connection
+    and returns a description of every mismatch. Extra live columns are fine.
+    """
+    inspector = sqlalchemy.inspect(conn)
+    problems = []
+    for table in metadata_obj.sorted_tables:
+        if not inspector.has_table(table.name):
+            problems.append(f"table {table.name} does not exist")
+            continue
+        live_columns = {c["name"]: c for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            live = live_columns.get(column.name)
+            if live is None:
+                problems.append(f"column {table.name}.{column.name} does not exist")
+            elif not _compatible(column.type, live["type"]):
+                problems.append(
+                    f"column {table.name}.{column.name} is {live['type']}, "
+                    f"expected {column.type}"
+                )
+    return problems
+
+
+def check_schema():
+    """Raises RuntimeError if the declared tables do not match the database."""
+    with get_engine().connect() as conn:
+        problems = schema_differences(conn)
+    if problems:
+        raise RuntimeError(
+            "schema does not match src/database.py "
+            "(run `python -m src.maintenance migrate`?): " + "; ".join(problems)
+        )
+
+
+# Engines are created on first use, not at import.
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = sqlalchemy.create_engine(database_connection_url())
+    return _engine
+
+
+def contains_pattern(substring):
+    """ILIKE pattern matching `substring` literally anywhere in the value."""
+    escaped = (
+        substring.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    )
+    return f"%{escaped}%"
+
+# asyncpg connections are bound to the event loop that opened them, so each
+# loop gets its own pool. A deployed server has exactly one loop; the test
+# client starts a fresh loop per request.
+_async_engines = weakref.WeakKeyDictionary()
+
+
+def get_async_engine():
+    loop = asyncio.get_running_loop()
+    async_engine = _async_engines.get(loop)
+    if async_engine is None:
+        # asyncpg prepares every statement and keeps the last N prepared per
+        # connection; N is sized above the number of distinct statements the
+        # handlers run, so each is planned once per connection.
+        # DB_STATEMENT_CACHE_SIZE=0 turns the cache off.
+        statement_cache_size = int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 256))
+        async_engine = create_async_engine(
+            database_connection_url("postgresql+asyncpg")
+            + f"?prepared_statement_cache_size={statement_cache_size}",
+            pool_size=int(os.environ.get("DB_POOL_SIZE", 20)),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        )
+        _async_engines[loop] = async_engine
+    return async_engine
+
+
+class SyncConnection:
+    """
+    Wraps a sync SQLAlchemy connection so handlers can `await conn.execute(...)`
+    the same way they would on an AsyncConnection. Every call runs on the
+    threadpool so the event loop is never blocked.
+    """
+
+    def __init__(self, conn):
+        self.sync_connection = conn
+
+    async def execute(self, *args, **kwargs):
+        return await run_in_threadpool(self.sync_connection.execute, *args, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def _sync_context(ctx):
+    conn = await run_in_threadpool(ctx.__enter__)
+    try:
+        yield SyncConnection(conn)
+    except BaseException as error:
+        if not await run_in_threadpool(
+            ctx.__exit__, type(error), error, error.__traceback__
+        ):
+            raise
+    else:
+        await run_in_threadpool(ctx.__exit__, None, None, None)
+
+
+def connect():
+    """Read-only connection: `async with db.connect() as conn:`."""
+    if ASYNC_DB:
+        return get_async_engine().connect()
+    return _sync_context(get_engine().connect())
+
+
+def begin():
+    """Connection inside a transaction that commits on exit, rolls back on error."""
+    if ASYNC_DB:
+        return get_async_engine().begin()
+    return _sync_context(get_engine().begin())
+
+
+async def stream(conn, statement, parameters=None, batch_size=1000):
+    """
+    Runs `statement` on a server-side cursor and yields its rows in lists of
+    up to `batch_size`, so only one batch is held in memory at a time.
+    """
+    if isinstance(conn, SyncConnection):
+        result = await run_in_threadpool(
+            conn.sync_connection.execution_options(stream_results=True).execute,
+            statement,
+            parameters,
+        )
+        try:
+            while True:
+                rows = await run_in_threadpool(result.fetchmany, batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            await run_in_threadpool(result.close)
+    else:
+        result = await conn.stream(statement, parameters)
+        try:
+            async for rows in result.partitions(batch_size):
+                yield rows
+        finally:
+            await result.close()
+
+
+def _copy_text(value):
+    # COPY's text format: \N is NULL, so an empty string stays an empty string
+    if value is None:
+        return "\\N"
+    if isinstance(value, (list, tuple)):
+        # integer arrays only, which need no quoting inside the braces
+        return "{" + ",".join(str(int(element)) for element in value) + "}"
+    return (
+        str(value).replace("\\", "\\\\").replace("\t", "\\t")
+        .replace("\n", "\\n").replace("\r", "\\r")
+    )
+
+
+async def copy_records(conn, table, columns, records):
+    """
+    Bulk-loads `records` (tuples in `columns` order) into `table` with COPY on
+    a connection from `connect()` / `begin()`. The COPY joins the open
+    transaction, so run at least one statement on `conn` first.
+    """
+    if isinstance(conn, SyncConnection):
+        buffer = io.StringIO(
+            "".join("\t".join(map(_copy_text, record)) + "\n" for record in records)
+        )
+
+        def copy():
+            with conn.sync_connection.connection.dbapi_connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer
+                )
 
+        await run_in_threadpool(copy)
+    else:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            table, records=records, columns=columns
+        )
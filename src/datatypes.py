@@ -20,6 +20,7 @@ class Movie:
     imdb_rating: float
     imdb_votes: int
     raw_script_url: str
+    num_lines: int
 
 
 @dataclass
@@ -0,0 +1,330 @@
+import asyncio
+import weakref
+from array import array
+from collections import deque
+
+import sqlalchemy
+
+from src import database as db
+
+# Who-talks-to-whom graph over characters, weighted by the lines each pair
+# has exchanged, for the neighborhood, path and centrality endpoints. It is
+# built from character_partners (conversations already folded into one row
+# per pair and direction) on first use and kept in compressed sparse row form:
+# the partners of node n are targets[offsets[n]:offsets[n + 1]], with the
+# matching weights, so a traversal touches flat arrays instead of Postgres.
+#
+# Conversations written through this process go into a small overlay as they
+# commit and are merged into the arrays once the overlay grows, including those
+# that commit while the graph loads. Like the snapshot, writes made by other
+# processes are not seen until the next load.
+
+# Merge the overlay once it holds this share of the edges.
+COMPACT_FRACTION = 8
+
+
+class Graph:
+    def __init__(self):
+        self.index = {}
+        self.character_ids = array("q")
+        self.names = []
+        self.movies = array("q")
+        self.movie_nodes = {}
+
+        self.offsets = array("q", [0])
+        self.targets = array("q")
+        self.weights = array("q")
+
+        # node -> {target: lines} written since the arrays were built
+        self.pending = {}
+        self.num_pending = 0
+
+    # -- loading ----------------------------------------------------------
+
+    async def load(self, conn):
+        # the edges and any later check of which conversations they include
+        # must see the same committed state
+        await conn.execute(
+            sqlalchemy.text(
+                "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"
+            )
+        )
+        result = await conn.execute(sqlalchemy.text("""
+        SELECT character_id, movie_id, name
+        FROM characters
+        ORDER BY character_id
+        """))
+        for row in result:
+            node = len(self.character_ids)
+            self.index[row.character_id] = node
+            self.character_ids.append(row.character_id)
+            self.names.append(row.name)
+            self.movies.append(row.movie_id)
+            self.movie_nodes.setdefault(row.movie_id, []).append(node)
+
+        # nodes were numbered in character_id order, so edges sorted by
+        # character_id arrive grouped by source node
+        counts = array("q", bytes(8 * len(self.character_ids)))
+        txt = """
+        SELECT character_id, partner_id, lines_together
+        FROM character_partners
+        WHERE lines_together > 0
+        ORDER BY character_id, partner_id
+        """
+        async for rows in db.stream(conn, sqlalchemy.text(txt), batch_size=10000):
+            for character_id, partner_id, lines_together in rows:
+                source = self.index.get(character_id)
+                target = self.index.get(partner_id)
+                if source is None or target is None:
+                    continue
+                counts[source] += 1
+                self.targets.append(target)
+                self.weights.append(lines_together)
+
+        total = 0
+        for count in counts:
+            total += count
+            self.offsets.append(total)
+
+    # -- writes -----------------------------------------------------------
+
+    def add_conversation(self, c1, c2, num_lines):
+        """
+        Adds a committed conversation's lines to the edge between its two
+        characters. Returns False if either character is unknown to the
+        graph, which then needs reloading.
+        """
+        a, b = self.index.get(c1), self.index.get(c2)
+        if a is None or b is None:
+            return False
+        if num_lines == 0 or a == b:
+            return True
+
+        for source, target in ((a, b), (b, a)):
+            edges = self.pending.setdefault(source, {})
+            if target not in edges:
+                self.num_pending += 1
+            edges[target] = edges.get(target, 0) + num_lines
+
+        if self.num_pending * COMPACT_FRACTION > max(len(self.targets), 1024):
+            self.compact()
+        return True
+
+    def compact(self):
+        """Rebuilds the arrays with the overlay merged in."""
+        offsets, targets, weights = array("q", [0]), array("q"), array("q")
+        for node in range(len(self.character_ids)):
+            for target, weight in sorted(self.neighbors(node)):
+                targets.append(target)
+                weights.append(weight)
+            offsets.append(len(targets))
+        self.offsets, self.targets, self.weights = offsets, targets, weights
+        self.pending = {}
+        self.num_pending = 0
+
+    # -- reads ------------------------------------------------------------
+
+    def neighbors(self, node):
+        """(target, lines) pairs for the partners of `node`."""
+        start, end = self.offsets[node], self.offsets[node + 1]
+        edges = zip(self.targets[start:end], self.weights[start:end])
+        pending = self.pending.get(node)
+        if not pending:
+            return edges
+
+        merged = dict(edges)
+        for target, weight in pending.items():
+            merged[target] = merged.get(target, 0) + weight
+        return merged.items()
+
+    def within(self, node, depth):
+        """
+        Every node at most `depth` hops from `node`, as {node: (hops, via,
+        lines)}, where `via` is the partner one hop closer that shares the
+        most lines with it and `lines` is how many.
+        """
+        ids = self.character_ids
+        found = {node: (0, None, 0)}
+        frontier = [node]
+        for hops in range(1, depth + 1):
+            reached = []
+            for via in frontier:
+                for target, lines in self.neighbors(via):
+                    seen = found.get(target)
+                    if seen is None:
+                        found[target] = (hops, via, lines)
+                        reached.append(target)
+                    elif seen[0] == hops:
+                        if (-lines, ids[via]) < (-seen[2], ids[seen[1]]):
+                            found[target] = (hops, via, lines)
+            frontier = reached
+        del found[node]
+        return found
+
+    def shortest_path(self, source, target):
+        """Nodes on a path with the fewest hops from `source` to `target`, or
+        None if they are not connected."""
+        parents = {source: None}
+        queue = deque([source])
+        while queue and target not in parents:
+            node = queue.popleft()
+            for partner, _ in sorted(self.neighbors(node)):
+                if partner not in parents:
+                    parents[partner] = node
+                    queue.append(partner)
+
+        if target not in parents:
+            return None
+
+        path = [target]
+        while parents[path[-1]] is not None:
+            path.append(parents[path[-1]])
+        path.reverse()
+        return path
+
+    def lines_between(self, a, b):
+        for target, lines in self.neighbors(a):
+            if target == b:
+                return lines
+        return 0
+
+    def centrality(self, movie_id):
+        """
+        Centrality of each character in the movie's conversation graph, as
+        {node: (partners, lines, closeness, betweenness)}. Closeness is the
+        Wasserman-Faust variant, so characters in small disconnected groups
+        are not ranked first; betweenness (Brandes) is normalized to 0..1.
+        Both count hops, not lines.
+        """
+        nodes = self.movie_nodes.get(movie_id, [])
+        members = set(nodes)
+        adjacency = {
+            node: [target for target, _ in self.neighbors(node) if target in members]
+            for node in nodes
+        }
+        n = len(nodes)
+        betweenness = dict.fromkeys(nodes, 0.0)
+        closeness = {}
+
+        for source in nodes:
+            # Brandes: shortest-path counts forward, dependencies backward
+            distance = {source: 0}
+            paths = dict.fromkeys(nodes, 0)
+            paths[source] = 1
+            predecessors = {node: [] for node in nodes}
+            order = []
+            queue = deque([source])
+            while queue:
+                node = queue.popleft()
+                order.append(node)
+                for partner in adjacency[node]:
+                    if partner not in distance:
+                        distance[partner] = distance[node] + 1
+                        queue.append(partner)
+                    if distance[partner] == distance[node] + 1:
+                        paths[partner] += paths[node]
+                        predecessors[partner].append(node)
+
+            dependency = dict.fromkeys(nodes, 0.0)
+            for node in reversed(order):
+                for predecessor in predecessors[node]:
+                    dependency[predecessor] += (
+                        paths[predecessor] / paths[node] * (1 + dependency[node])
+                    )
+                if node != source:
+                    betweenness[node] += dependency[node]
+
+            reachable = len(distance) - 1
+            total_distance = sum(distance.values())
+            closeness[source] = (
+                reachable / (n - 1) * reachable / total_distance
+                if total_distance
+                else 0.0
+            )
+
+        # every pair was counted from both ends
+        scale = 1 / ((n - 1) * (n - 2)) if n > 2 else 0.0
+        return {
+            node: (
+                len(adjacency[node]),
+                sum(
+                    lines for target, lines in self.neighbors(node) if target in members
+                ),
+                closeness[node],
+                betweenness[node] * scale,
+            )
+            for node in nodes
+        }
+
+
+# The loaded graph, or None until the first request that needs it.
+current = None
+
+# (conversation_id, c1, c2, num_lines) for each conversation committed while
+# a load runs, or None when none is running.
+_committed_during_load = None
+
+# One per event loop, since a lock cannot be shared between loops and the
+# test client runs each request on a new one.
+_load_locks = weakref.WeakKeyDictionary()
+
+
+def _load_lock():
+    loop = asyncio.get_running_loop()
+    lock = _load_locks.get(loop)
+    if lock is None:
+        lock = _load_locks[loop] = asyncio.Lock()
+    return lock
+
+
+async def load():
+    global current, _committed_during_load
+    _committed_during_load = []
+    try:
+        graph = Graph()
+        async with db.connect() as conn:
+            await graph.load(conn)
+            # Replay what committed after the load's transaction began. Ids are
+            # handed out in blocks, so they do not follow commit order; ask the
+            # transaction which conversations it already saw instead.
+            checked = 0
+            while checked < len(_committed_during_load):
+                written = _committed_during_load[checked:]
+                checked = len(_committed_during_load)
+                result = await conn.execute(
+                    sqlalchemy.text("""
+                    SELECT conversation_id FROM conversations
+                    WHERE conversation_id = ANY(:ids)
+                    """),
+                    {"ids": [conv_id for conv_id, _, _, _ in written]},
+                )
+                seen = set(result.scalars())
+                for conv_id, c1, c2, num_lines in written:
+                    if conv_id in seen:
+                        continue
+                    if not graph.add_conversation(c1, c2, num_lines):
+                        # a character added since the load began; load again
+                        return
+            current = graph
+    finally:
+        _committed_during_load = None
+
+
+async def get():
+    """The graph, loading it first if this process has not yet."""
+    if current is None:
+        async with _load_lock():
+            # another request may have loaded it while this one waited
+            while current is None:
+                await load()
+    return current
+
+
+def add_conversation(conv_id, c1, c2, num_lines):
+    """Applies a committed conversation to the loaded graph and to the one
+    being loaded, if any."""
+    global current
+    if _committed_during_load is not None:
+        _committed_during_load.append((conv_id, c1, c2, num_lines))
+    if current is not None and not current.add_conversation(c1, c2, num_lines):
+        current = None
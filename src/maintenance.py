@@ -0,0 +1,282 @@
+import argparse
+import sqlalchemy
+
+from src import database as db
+
+# Schema changes and rebuilds for the derived data the API maintains on top of
+# the original movies/characters/conversations/lines tables.
+#
+#   python -m src.maintenance migrate
+#   python -m src.maintenance rebuild-line-counts
+#   python -m src.maintenance rebuild-character-partners
+#   python -m src.maintenance rebuild-conversation-lines
+#   python -m src.maintenance rebuild-movie-stats
+
+def _id_sequence(table, column):
+    # Gives `column` a sequence default (unless it already has one) and moves
+    # the sequence past the ids that are already taken, never backwards.
+    return f"""
+    DO $$
+    BEGIN
+        IF pg_get_serial_sequence('{table}', '{column}') IS NULL THEN
+            CREATE SEQUENCE {table}_{column}_seq OWNED BY {table}.{column};
+            ALTER TABLE {table} ALTER COLUMN {column}
+                SET DEFAULT nextval('{table}_{column}_seq');
+        END IF;
+        PERFORM setval(
+            pg_get_serial_sequence('{table}', '{column}'),
+            GREATEST(
+                COALESCE(MAX({column}), 0),
+                COALESCE(pg_sequence_last_value(
+                    pg_get_serial_sequence('{table}', '{column}')
+                ), 0)
+            ) + 1,
+            false
+        ) FROM {table};
+    END $$
+    """
+
+
+MIGRATIONS = [
+    # per-character and per-movie line counts, kept current by add_conversation
+    """
+    ALTER TABLE characters ADD COLUMN IF NOT EXISTS num_lines integer NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE movies ADD COLUMN IF NOT EXISTS num_lines integer NOT NULL DEFAULT 0
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS characters_num_lines_idx
+    ON characters (num_lines DESC, character_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS characters_movie_num_lines_idx
+    ON characters (movie_id, num_lines DESC, character_id)
+    """,
+    # trigram indexes so the substring `name` filters can avoid a seq scan
+    """
+    CREATE EXTENSION IF NOT EXISTS pg_trgm
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS characters_name_trgm_idx
+    ON characters USING gin (name gin_trgm_ops)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS movies_title_trgm_idx
+    ON movies USING gin (title gin_trgm_ops)
+    """,
+    # conversation partners in both directions, kept current by add_conversation
+    """
+    CREATE TABLE IF NOT EXISTS character_partners (
+        character_id integer NOT NULL,
+        partner_id integer NOT NULL,
+        lines_together integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (character_id, partner_id)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS character_partners_top_idx
+    ON character_partners (character_id, lines_together DESC, partner_id)
+    """,
+    # new conversation and line ids come from sequences
+    _id_sequence("conversations", "conversation_id"),
+    _id_sequence("lines", "line_id"),
+    # bumped after every write; ETags are derived from it
+    """
+    CREATE SEQUENCE IF NOT EXISTS data_version_seq
+    """,
+    # each conversation's line ids in line_sort order, kept by add_conversation
+    """
+    ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS line_ids integer[] NOT NULL DEFAULT '{}'
+    """,
+    """
+    ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS num_lines integer NOT NULL DEFAULT 0
+    """,
+    # per-movie dialogue statistics, kept current by add_conversation
+    """
+    ALTER TABLE characters ADD COLUMN IF NOT EXISTS num_words integer NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE movies ADD COLUMN IF NOT EXISTS num_words integer NOT NULL DEFAULT 0
+    """,
+    """
+    ALTER TABLE movies
+        ADD COLUMN IF NOT EXISTS num_conversations integer NOT NULL DEFAULT 0
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS movie_gender_lines (
+        movie_id integer NOT NULL,
+        gender text NOT NULL,
+        num_lines integer NOT NULL DEFAULT 0,
+        PRIMARY KEY (movie_id, gender)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS conversations_movie_num_lines_idx
+    ON conversations (movie_id, num_lines DESC, conversation_id)
+    """,
+    # full-text search over line_text. The column is generated, so adding it
+    # rewrites lines once and inserts keep it current afterwards. btree_gin
+    # lets the movie_id and character_id filters live in the same GIN index.
+    """
+    ALTER TABLE lines ADD COLUMN IF NOT EXISTS line_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', COALESCE(line_text, ''))) STORED
+    """,
+    """
+    CREATE EXTENSION IF NOT EXISTS btree_gin
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS lines_search_idx
+    ON lines USING gin (line_tsv, movie_id, character_id)
+    """,
+]
+
+
+def migrate(conn):
+    for txt in MIGRATIONS:
+        conn.execute(sqlalchemy.text(txt))
+
+
+def rebuild_line_counts(conn):
+    """Recomputes characters.num_lines and movies.num_lines from lines."""
+    conn.execute(sqlalchemy.text("""
+    UPDATE characters AS c
+    SET num_lines = COALESCE(counts.num_lines, 0)
+    FROM characters AS c2
+    LEFT JOIN (
+        SELECT character_id, COUNT(*) AS num_lines
+        FROM lines
+        GROUP BY character_id
+    ) AS counts ON counts.character_id = c2.character_id
+    WHERE c.character_id = c2.character_id
+    AND c.num_lines IS DISTINCT FROM COALESCE(counts.num_lines, 0)
+    """))
+
+    conn.execute(sqlalchemy.text("""
+    UPDATE movies AS m
+    SET num_lines = COALESCE(counts.num_lines, 0)
+    FROM movies AS m2
+    LEFT JOIN (
+        SELECT movie_id, COUNT(*) AS num_lines
+        FROM lines
+        GROUP BY movie_id
+    ) AS counts ON counts.movie_id = m2.movie_id
+    WHERE m.movie_id = m2.movie_id
+    AND m.num_lines IS DISTINCT FROM COALESCE(counts.num_lines, 0)
+    """))
+
+
+def rebuild_character_partners(conn):
+    """Recomputes character_partners from conversations and lines."""
+    conn.execute(sqlalchemy.text("DELETE FROM character_partners"))
+    conn.execute(sqlalchemy.text("""
+    INSERT INTO character_partners (character_id, partner_id, lines_together)
+    SELECT pair.character_id, pair.partner_id, SUM(conv_lines.num_lines)
+    FROM (
+        SELECT conversation_id, COUNT(*) AS num_lines
+        FROM lines
+        GROUP BY conversation_id
+    ) AS conv_lines
+    JOIN conversations AS conv ON conv.conversation_id = conv_lines.conversation_id
+    CROSS JOIN LATERAL (
+        VALUES (conv.character1_id, conv.character2_id),
+               (conv.character2_id, conv.character1_id)
+    ) AS pair (character_id, partner_id)
+    WHERE pair.character_id != pair.partner_id
+    GROUP BY pair.character_id, pair.partner_id
+    """))
+
+
+def rebuild_conversation_lines(conn):
+    """Recomputes conversations.line_ids and conversations.num_lines from lines."""
+    conn.execute(sqlalchemy.text("""
+    UPDATE conversations AS conv
+    SET line_ids = COALESCE(agg.line_ids, '{}'), num_lines = COALESCE(agg.num_lines, 0)
+    FROM conversations AS conv2
+    LEFT JOIN (
+        SELECT conversation_id,
+            array_agg(line_id ORDER BY line_sort, line_id) AS line_ids,
+            COUNT(*) AS num_lines
+        FROM lines
+        GROUP BY conversation_id
+    ) AS agg ON agg.conversation_id = conv2.conversation_id
+    WHERE conv.conversation_id = conv2.conversation_id
+    AND (
+        conv.line_ids IS DISTINCT FROM COALESCE(agg.line_ids, '{}')
+        OR conv.num_lines IS DISTINCT FROM COALESCE(agg.num_lines, 0)
+    )
+    """))
+
+
+def rebuild_movie_stats(conn):
+    """
+    Recomputes the word counts on characters and movies, movies.num_conversations
+    and movie_gender_lines from conversations and lines. A word is a run of
+    non-whitespace, as in `conversations.word_count`.
+    """
+    conn.execute(sqlalchemy.text("""
+    UPDATE characters AS c
+    SET num_words = COALESCE(counts.num_words, 0)
+    FROM characters AS c2
+    LEFT JOIN (
+        SELECT character_id, SUM(words.n) AS num_words
+        FROM lines
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS n FROM regexp_matches(line_text, '[^[:space:]]+', 'g')
+        ) AS words
+        GROUP BY character_id
+    ) AS counts ON counts.character_id = c2.character_id
+    WHERE c.character_id = c2.character_id
+    AND c.num_words IS DISTINCT FROM COALESCE(counts.num_words, 0)
+    """))
+
+    conn.execute(sqlalchemy.text("""
+    UPDATE movies AS m
+    SET num_words = COALESCE(words.num_words, 0),
+        num_conversations = COALESCE(convs.num_conversations, 0)
+    FROM movies AS m2
+    LEFT JOIN (
+        SELECT movie_id, SUM(num_words) AS num_words
+        FROM characters
+        GROUP BY movie_id
+    ) AS words ON words.movie_id = m2.movie_id
+    LEFT JOIN (
+        SELECT movie_id, COUNT(*) AS num_conversations
+        FROM conversations
+        GROUP BY movie_id
+    ) AS convs ON convs.movie_id = m2.movie_id
+    WHERE m.movie_id = m2.movie_id
+    AND (
+        m.num_words IS DISTINCT FROM COALESCE(words.num_words, 0)
+        OR m.num_conversations IS DISTINCT FROM COALESCE(convs.num_conversations, 0)
+    )
+    """))
+
+    conn.execute(sqlalchemy.text("DELETE FROM movie_gender_lines"))
+    conn.execute(sqlalchemy.text("""
+    INSERT INTO movie_gender_lines (movie_id, gender, num_lines)
+    SELECT lines.movie_id, COALESCE(c.gender, '?'), COUNT(*)
+    FROM lines
+    JOIN characters AS c ON c.character_id = lines.character_id
+    GROUP BY lines.movie_id, COALESCE(c.gender, '?')
+    """))
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "rebuild-line-counts": rebuild_line_counts,
+    "rebuild-character-partners": rebuild_character_partners,
+    "rebuild-conversation-lines": rebuild_conversation_lines,
+    "rebuild-movie-stats": rebuild_movie_stats,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Movie API schema maintenance.")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    with db.get_engine().begin() as conn:
+        COMMANDS[args.command](conn)
@@ -0,0 +1,135 @@
+import bisect
+import contextvars
+import threading
+import time
+
+import sqlalchemy
+
+# Per-request query accounting and process-wide Prometheus histograms.
+# SQLAlchemy's cursor events add every statement's time to the stats of the
+# request that ran it; the contextvar follows the request onto the threadpool
+# (DB_ASYNC=0) and into SQLAlchemy's greenlets (DB_ASYNC=1). Like the cache,
+# each worker process keeps its own histograms.
+
+
+class RequestStats:
+    def __init__(self, scope):
+        self.scope = scope
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+
+    @property
+    def route(self):
+        """The matched route template, once routing has happened."""
+        route = self.scope.get("route")
+        return route.path if route is not None else "unmatched"
+
+    def server_timing(self):
+        """The Server-Timing header value, durations in milliseconds."""
+        total = time.perf_counter() - self.started
+        return (
+            f"db;dur={self.db_time * 1000:.2f}, "
+            f"db-queries;desc={self.queries}, "
+            f"serialize;dur={self.serialize_time * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+# Called after every statement with (statement, parameters, seconds,
+# executemany, RequestStats or None).
+query_listeners = []
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+    for listener in query_listeners:
+        listener(statement, parameters, elapsed, executemany, stats)
+
+
+sqlalchemy.event.listen(
+    sqlalchemy.engine.Engine, "before_cursor_execute", _before_cursor_execute
+)
+sqlalchemy.event.listen(
+    sqlalchemy.engine.Engine, "after_cursor_execute", _after_cursor_execute
+)
+
+
+def add_serialize_time(seconds):
+    stats = current_request.get()
+    if stats is not None:
+        stats.serialize_time += seconds
+
+
+class Histogram:
+    """A Prometheus histogram with one label."""
+
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = list(buckets)
+        # label value -> [per-bucket counts..., +Inf count], sum
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            counts, total = self._series.get(label_value, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._series[label_value] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for label_value, (counts, total) in series:
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by route.",
+    "route",
+    [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+)
+request_queries = Histogram(
+    "http_request_db_queries",
+    "SQL statements executed per request, by route.",
+    "route",
+    [0, 1, 2, 3, 5, 10, 25, 50, 100],
+)
+
+
+def observe(stats):
+    request_duration.observe(stats.route, time.perf_counter() - stats.started)
+    request_queries.observe(stats.route, stats.queries)
+
+
+def render():
+    """All histograms in the Prometheus text exposition format."""
+    return "\n".join(request_duration.render() + request_queries.render()) + "\n"
@@ -0,0 +1,117 @@
+import collections
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+
+from src import database as db
+from src import metrics
+
+# Records statements slower than SLOW_QUERY_MS with their normalized SQL,
+# parameters and route, and for a sample of them the plan from re-running
+# the statement under EXPLAIN (ANALYZE, BUFFERS) on a separate connection.
+# The most recent entries are served by /slowqueries/.
+
+logger = logging.getLogger(__name__)
+
+THRESHOLD = float(os.environ.get("SLOW_QUERY_MS", 500)) / 1000
+EXPLAIN_RATE = float(os.environ.get("SLOW_QUERY_EXPLAIN_RATE", 0.1))
+# parameters are replaced by their type names unless SLOW_QUERY_REDACT=0
+REDACT = db.env_flag("SLOW_QUERY_REDACT", default=True)
+
+entries = collections.deque(maxlen=int(os.environ.get("SLOW_QUERY_LOG_SIZE", 100)))
+_lock = threading.Lock()
+# one background connection, so a burst of slow queries cannot add a burst
+# of EXPLAIN ANALYZE load on top
+_explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+
+_whitespace = re.compile(r"\s+")
+_string_literal = re.compile(r"'(?:[^']|'')*'")
+_number_literal = re.compile(r"(?<![\w$])\d+(?:\.\d+)?\b")
+_numbered_param = re.compile(r"\$(\d+)")
+
+
+def normalize(statement):
+    """Collapses whitespace and replaces literals with `?`."""
+    statement = _string_literal.sub("?", statement)
+    statement = _number_literal.sub("?", statement)
+    return _whitespace.sub(" ", statement).strip()
+
+
+def redact(parameters):
+    if not REDACT:
+        return parameters
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+def _explainable(statement):
+    # ANALYZE runs the statement, so only plain reads are re-run, and the
+    # transaction is read-only and rolled back regardless
+    return statement.lstrip().upper().startswith("SELECT")
+
+
+def _pyformat(statement, parameters):
+    """asyncpg's `$1` parameters as psycopg2 `%(p1)s` parameters."""
+    if isinstance(parameters, dict):
+        return statement, parameters
+    statement = _numbered_param.sub(r"%(p\1)s", statement.replace("%", "%%"))
+    return statement, {f"p{i}": value for i, value in enumerate(parameters, start=1)}
+
+
+def _explain(entry, statement, parameters):
+    statement, parameters = _pyformat(statement, parameters)
+    try:
+        with db.get_engine().connect() as conn:
+            conn.exec_driver_sql("SET TRANSACTION READ ONLY")
+            result = conn.exec_driver_sql(
+                "EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters
+            )
+            entry["plan"] = "\n".join(row[0] for row in result)
+            conn.rollback()
+    except sqlalchemy.exc.SQLAlchemyError as error:
+        entry["plan_error"] = str(error)
+
+
+def record(statement, parameters, elapsed, executemany, stats):
+    if (
+        elapsed < THRESHOLD
+        or executemany
+        or statement.lstrip().upper().startswith("EXPLAIN")
+    ):
+        return
+
+    entry = {
+        "at": time.time(),
+        "duration_ms": round(elapsed * 1000, 2),
+        "route": stats.route if stats is not None else None,
+        "statement": normalize(statement),
+        "parameters": redact(parameters),
+        "plan": None,
+    }
+    with _lock:
+        entries.append(entry)
+    logger.warning(
+        "slow query (%.1f ms) on %s: %s",
+        entry["duration_ms"],
+        entry["route"],
+        entry["statement"],
+    )
+
+    if _explainable(statement) and random.random() < EXPLAIN_RATE:
+        _explainer.submit(_explain, entry, statement, parameters)
+
+
+def recent():
+    """Logged entries, newest first."""
+    with _lock:
+        return list(reversed(entries))
+
+
+metrics.query_listeners.append(record)
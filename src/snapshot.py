@@ -0,0 +1,578 @@
+import bisect
+import sys
+from array import array
+from collections import namedtuple
+from itertools import islice
+
+import sqlalchemy
+
+from src import database as db
+
+# In-memory snapshot of movies, characters, conversations and lines that can
+# answer the read endpoints without Postgres. Turned on with SNAPSHOT_MODE=1:
+# the snapshot is loaded at startup and handlers fall back to the database
+# until it is ready.
+#
+# Columns are kept in arrays and lists of interned strings. Text ordering is
+# never decided in Python: the load asks Postgres for DENSE_RANK()s of the
+# text columns so every sort matches the database collation exactly.
+#
+# Writes made through this process are applied as they commit, including
+# those that commit while the snapshot loads. Writes made by other processes
+# are not seen until the next load.
+
+# Rows handed back to the route handlers carry the same labels as their SQL.
+CharacterListRow = namedtuple("CharacterListRow", "id name title num_lines")
+MovieListRow = namedtuple("MovieListRow", "movie_id title year imdb_rating imdb_votes")
+LineListRow = namedtuple(
+    "LineListRow", "line_id conversation_id movie_id character1_name character2_name"
+)
+CharacterRow = namedtuple("CharacterRow", "id name movie gender")
+PartnerRow = namedtuple("PartnerRow", "id name gender num_lines_together")
+MovieRow = namedtuple("MovieRow", "movie_id title")
+TopCharacterRow = namedtuple("TopCharacterRow", "id name num_lines")
+LineRow = namedtuple("LineRow", "line_id title conversation_id name line_text")
+ConversationLineRow = namedtuple(
+    "ConversationLineRow", "line_id conversation_id movie_id line_sort name line_text"
+)
+
+
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
+def _insort(order, item, key):
+    """Inserts `item` into `order`, which is sorted by `key`."""
+    lo, hi = 0, len(order)
+    item_key = key(item)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(order[mid]) <= item_key:
+            lo = mid + 1
+        else:
+            hi = mid
+    order.insert(lo, item)
+
+
+def _bisect_after(order, after, key):
+    """First position in `order` (sorted by `key`) whose key is > `after`."""
+    lo, hi = 0, len(order)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key(order[mid]) <= after:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Snapshot:
+    def __init__(self):
+        # movies
+        self.movie_index = {}
+        self.movie_ids = array("q")
+        self.titles = []
+        self.titles_folded = []
+        self.years = []
+        self.ratings = []
+        self.votes = []
+        self.title_ranks = array("q")
+        self.movie_orders = {}
+        self.movie_characters = {}
+
+        # characters
+        self.character_index = {}
+        self.character_ids = array("q")
+        self.names = []
+        self.names_folded = []
+        self.character_movies = array("q")
+        self.genders = []
+        self.name_ranks = []
+        self.num_lines = array("q")
+        self.partners = {}
+        self.character_orders = {}
+
+        # conversations
+        self.conversation_index = {}
+        self.conversation_c1 = array("q")
+        self.conversation_c2 = array("q")
+        self.conversation_ids = []
+        self.conversation_lines = {}
+
+        # lines
+        self.line_index = {}
+        self.line_ids = array("q")
+        self.line_characters = array("q")
+        self.line_movies = array("q")
+        self.line_conversations = array("q")
+        self.line_sorts = array("q")
+        self.line_texts = []
+        self.line_order = array("q")
+        self.movie_lines = {}
+
+    # -- loading ----------------------------------------------------------
+
+    async def load(self, conn):
+        # every read below sees the same committed state, so no line can
+        # point at a conversation the snapshot does not have
+        await conn.execute(
+            sqlalchemy.text(
+                "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY"
+            )
+        )
+
+        result = await conn.execute(sqlalchemy.text("""
+        SELECT movie_id, title, year, imdb_rating, imdb_votes,
+            DENSE_RANK() OVER (ORDER BY title ASC) AS title_rank,
+            DENSE_RANK() OVER (ORDER BY year ASC) AS year_rank,
+            DENSE_RANK() OVER (ORDER BY imdb_rating DESC) AS rating_rank
+        FROM movies
+        """))
+        year_ranks, rating_ranks = [], []
+        for row in result:
+            self.movie_index[row.movie_id] = len(self.movie_ids)
+            self.movie_ids.append(row.movie_id)
+            self.titles.append(_intern(row.title))
+            self.titles_folded.append(None if row.title is None else row.title.lower())
+            self.years.append(row.year)
+            self.ratings.append(row.imdb_rating)
+            self.votes.append(row.imdb_votes)
+            self.title_ranks.append(row.title_rank)
+            year_ranks.append(row.year_rank)
+            rating_ranks.append(row.rating_rank)
+            self.movie_characters[row.movie_id] = []
+
+        ids = self.movie_ids
+        movies = range(len(ids))
+        self.movie_orders = {
+            "movie_title": sorted(movies, key=lambda m: (self.title_ranks[m], ids[m])),
+            "year": sorted(movies, key=lambda m: (year_ranks[m], ids[m])),
+            "rating": sorted(movies, key=lambda m: (rating_ranks[m], ids[m])),
+        }
+
+        result = await conn.execute(sqlalchemy.text("""
+        SELECT character_id, name, movie_id, gender,
+            DENSE_RANK() OVER (ORDER BY name ASC) AS name_rank
+        FROM characters
+        """))
+        for row in result:
+            c = len(self.character_ids)
+            self.character_index[row.character_id] = c
+            self.character_ids.append(row.character_id)
+            self.names.append(_intern(row.name))
+            self.names_folded.append(None if row.name is None else row.name.lower())
+            self.character_movies.append(row.movie_id)
+            self.genders.append(_intern(row.gender))
+            self.name_ranks.append(None if row.name is None else row.name_rank)
+            self.num_lines.append(0)
+            if row.movie_id in self.movie_characters:
+                self.movie_characters[row.movie_id].append(c)
+
+        result = await conn.execute(sqlalchemy.text("""
+        SELECT conversation_id, character1_id, character2_id
+        FROM conversations
+        ORDER BY conversation_id
+        """))
+        for row in result:
+            self._add_conversation(
+                row.conversation_id, row.character1_id, row.character2_id
+            )
+
+        txt = """
+        SELECT line_id, character_id, movie_id, conversation_id, line_sort, line_text
+        FROM lines
+        ORDER BY line_id
+        """
+        async for rows in db.stream(conn, sqlalchemy.text(txt), batch_size=10000):
+            for row in rows:
+                self._add_line(*row)
+
+        for conv_id, lines in self.conversation_lines.items():
+            self._add_partner_lines(conv_id, len(lines))
+
+        self._sort_characters()
+
+    def _sort_characters(self):
+        ids = self.character_ids
+        listed = [
+            c
+            for c in range(len(ids))
+            if self.names[c] is not None
+            and self.character_movies[c] in self.movie_index
+        ]
+        self.character_orders = {
+            "character": sorted(listed, key=lambda c: (self.name_ranks[c], ids[c])),
+            "movie": sorted(listed, key=lambda c: (self._title_rank(c), ids[c])),
+        }
+        self.character_orders["number_of_lines"] = None
+
+    def _title_rank(self, c):
+        return self.title_ranks[self.movie_index[self.character_movies[c]]]
+
+    def _lines_order(self):
+        # number_of_lines changes with every write, so it is re-sorted lazily
+        order = self.character_orders["number_of_lines"]
+        if order is None:
+            order = sorted(
+                self.character_orders["character"],
+                key=lambda c: (
+                    -self.num_lines[c],
+                    self._title_rank(c),
+                    self.character_ids[c],
+                ),
+            )
+            self.character_orders["number_of_lines"] = order
+        return order
+
+    # -- incremental updates ----------------------------------------------
+
+    def _add_conversation(self, conv_id, c1, c2):
+        self.conversation_index[conv_id] = len(self.conversation_c1)
+        self.conversation_c1.append(c1)
+        self.conversation_c2.append(c2)
+        self.conversation_lines.setdefault(conv_id, array("q"))
+        if self.conversation_ids and conv_id < self.conversation_ids[-1]:
+            _insort(self.conversation_ids, conv_id, lambda id: id)
+        else:
+            self.conversation_ids.append(conv_id)
+
+    def _add_line(self, line_id, character_id, movie_id, conv_id, line_sort, line_text):
+        row = len(self.line_ids)
+        self.line_index[line_id] = row
+        self.line_ids.append(line_id)
+        self.line_characters.append(character_id)
+        self.line_movies.append(movie_id)
+        self.line_conversations.append(conv_id)
+        self.line_sorts.append(line_sort)
+        self.line_texts.append(line_text)
+
+        by_id = self.line_ids.__getitem__
+        for order in (
+            self.line_order,
+            self.movie_lines.setdefault(movie_id, array("q")),
+            self.conversation_lines.setdefault(conv_id, array("q")),
+        ):
+            if order and line_id < self.line_ids[order[-1]]:
+                _insort(order, row, by_id)
+            else:
+                order.append(row)
+
+        c = self.character_index.get(character_id)
+        if c is not None:
+            self.num_lines[c] += 1
+
+    def _add_partner_lines(self, conv_id, num_lines):
+        i = self.conversation_index.get(conv_id)
+        if i is None or num_lines == 0:
+            return
+        c1, c2 = self.conversation_c1[i], self.conversation_c2[i]
+        if c1 == c2:
+            return
+        for a, b in ((c1, c2), (c2, c1)):
+            partners = self.partners.setdefault(a, {})
+            partners[b] = partners.get(b, 0) + num_lines
+
+    def add_conversation(self, movie_id, conv_id, c1, c2, lines):
+        """Applies a committed conversation. `lines` holds
+        (line_id, character_id, line_sort, line_text) tuples."""
+        self._add_conversation(conv_id, c1, c2)
+        for line_id, character_id, line_sort, line_text in lines:
+            self._add_line(
+                line_id, character_id, movie_id, conv_id, line_sort, line_text
+            )
+        self._add_partner_lines(conv_id, len(lines))
+        self.character_orders["number_of_lines"] = None
+
+    # -- characters -------------------------------------------------------
+
+    def _character_list_row(self, c):
+        movie = self.movie_index[self.character_movies[c]]
+        return CharacterListRow(
+            self.character_ids[c], self.names[c], self.titles[movie], self.num_lines[c]
+        )
+
+    def list_characters(self, name, limit, offset, sort, after=None):
+        """`after` is the decoded cursor, (keys, id), or None."""
+        if sort == "number_of_lines":
+            order = self._lines_order()
+        else:
+            order = self.character_orders[sort]
+
+        start = 0
+        if after is not None:
+            keys, after_id = after
+            c = self.character_index.get(after_id)
+            if c is None:
+                return []
+            if sort == "character":
+                after_key = (self.name_ranks[c], after_id)
+
+                def key(c):
+                    return (self.name_ranks[c], self.character_ids[c])
+
+            elif sort == "movie":
+                after_key = (self._title_rank(c), after_id)
+
+                def key(c):
+                    return (self._title_rank(c), self.character_ids[c])
+
+            else:
+                after_key = (-keys[0], self._title_rank(c), after_id)
+
+                def key(c):
+                    return (
+                        -self.num_lines[c],
+                        self._title_rank(c),
+                        self.character_ids[c],
+                    )
+
+            start = _bisect_after(order, after_key, key)
+
+        folded = name.lower()
+        matches = (
+            c for c in islice(order, start, None)
+            if self.num_lines[c] > 0 and folded in self.names_folded[c]
+        )
+        return [
+            self._character_list_row(c) for c in islice(matches, offset, offset + limit)
+        ]
+
+    def get_character(self, id, limit, offset):
+        """Returns (CharacterRow, [PartnerRow]) or None."""
+        c = self.character_index.get(id)
+        if c is None or self.character_movies[c] not in self.movie_index:
+            return None
+
+        movie = self.movie_index[self.character_movies[c]]
+        character = CharacterRow(id, self.names[c], self.titles[movie], self.genders[c])
+
+        partners = sorted(
+            (
+                (-n, partner_id) for partner_id, n in self.partners.get(id, {}).items()
+                if partner_id in self.character_index
+            )
+        )
+        top_conv = []
+        for n, partner_id in partners[offset:offset + limit]:
+            p = self.character_index[partner_id]
+            top_conv.append(PartnerRow(partner_id, self.names[p], self.genders[p], -n))
+
+        return character, top_conv
+
+    # -- movies -----------------------------------------------------------
+
+    def list_movies(self, name, limit, offset, sort, after=None):
+        order = self.movie_orders[sort]
+
+        start = 0
+        if after is not None:
+            _, after_id = after
+            m = self.movie_index.get(after_id)
+            if m is None:
+                return []
+            start = order.index(m) + 1
+
+        folded = name.lower()
+        matches = (
+            m
+            for m in islice(order, start, None)
+            if name == ""
+            or (self.titles_folded[m] is not None and folded in self.titles_folded[m])
+        )
+        return [
+            MovieListRow(
+                self.movie_ids[m],
+                self.titles[m],
+                self.years[m],
+                self.ratings[m],
+                self.votes[m],
+            )
+            for m in islice(matches, offset, offset + limit)
+        ]
+
+    def get_movie(self, movie_id):
+        """Returns (MovieRow, [TopCharacterRow]) or None."""
+        m = self.movie_index.get(movie_id)
+        if m is None:
+            return None
+
+        top = sorted(
+            (c for c in self.movie_characters[movie_id] if self.num_lines[c] > 0),
+            key=lambda c: (-self.num_lines[c], self.character_ids[c]),
+        )[:5]
+        return (
+            MovieRow(movie_id, self.titles[m]),
+            [
+                TopCharacterRow(self.character_ids[c], self.names[c], self.num_lines[c])
+                for c in top
+            ],
+        )
+
+    # -- lines ------------------------------------------------------------
+
+    def _line_list_row(self, row):
+        conv_id = self.line_conversations[row]
+        i = self.conversation_index.get(conv_id)
+        if i is None:
+            return None
+        c1 = self.character_index.get(self.conversation_c1[i])
+        c2 = self.character_index.get(self.conversation_c2[i])
+        if c1 is None or c2 is None:
+            return None
+        return LineListRow(
+            self.line_ids[row],
+            conv_id,
+            self.line_movies[row],
+            self.names[c1],
+            self.names[c2],
+        )
+
+    def _lines_in_order(self, sort, after):
+        """All lines in `sort` order, starting after the decoded cursor `after`."""
+        by_id = self.line_ids.__getitem__
+
+        if sort == "line_id":
+            start = (
+                0 if after is None else _bisect_after(self.line_order, after[1], by_id)
+            )
+            yield from islice(self.line_order, start, None)
+        elif sort == "movie_id":
+            movie_ids = sorted(self.movie_lines)
+            start = 0 if after is None else bisect.bisect_left(movie_ids, after[0])
+            for movie_id in islice(movie_ids, start, None):
+                block = self.movie_lines[movie_id]
+                if after is not None and movie_id == after[0]:
+                    block = islice(block, _bisect_after(block, after[1], by_id), None)
+                yield from block
+        else:
+            # conversation_id descending, then line_id ascending
+            conv_ids = self.conversation_ids
+            end = (
+                len(conv_ids)
+                if after is None
+                else bisect.bisect_right(conv_ids, after[0])
+            )
+            for i in range(end - 1, -1, -1):
+                block = self.conversation_lines[conv_ids[i]]
+                if after is not None and conv_ids[i] == after[0]:
+                    block = islice(block, _bisect_after(block, after[1], by_id), None)
+                yield from block
+
+    def list_lines(self, movie_id, conversation_id, limit, offset, sort, after=None):
+        """`after` is the decoded cursor, (keys, id), or None."""
+        if movie_id is None and conversation_id is None:
+            candidates = self._lines_in_order(
+                sort, None if after is None else (after[0][0], after[1])
+            )
+        else:
+            if sort == "line_id":
+
+                def key(r):
+                    return (self.line_ids[r],)
+
+            elif sort == "movie_id":
+
+                def key(r):
+                    return (self.line_movies[r], self.line_ids[r])
+
+            else:
+
+                def key(r):
+                    return (-self.line_conversations[r], self.line_ids[r])
+
+            if conversation_id is not None:
+                candidates = self.conversation_lines.get(conversation_id, ())
+            else:
+                candidates = self.movie_lines.get(movie_id, ())
+            candidates = sorted(
+                (
+                    r
+                    for r in candidates
+                    if movie_id is None or self.line_movies[r] == movie_id
+                ),
+                key=key,
+            )
+
+            if after is not None:
+                (after_key,), after_id = after
+                if sort == "line_id":
+                    bound = (after_id,)
+                elif sort == "movie_id":
+                    bound = (after_key, after_id)
+                else:
+                    bound = (-after_key, after_id)
+                candidates = [r for r in candidates if key(r) > bound]
+
+        rows = (self._line_list_row(r) for r in candidates)
+        return list(
+            islice((row for row in rows if row is not None), offset, offset + limit)
+        )
+
+    def get_line(self, line_id):
+        row = self.line_index.get(line_id)
+        if row is None:
+            return None
+        m = self.movie_index.get(self.line_movies[row])
+        c = self.character_index.get(self.line_characters[row])
+        if m is None or c is None:
+            return None
+        return LineRow(
+            line_id,
+            self.titles[m],
+            self.line_conversations[row],
+            self.names[c],
+            self.line_texts[row],
+        )
+
+    def conversation_lines_sorted(self, conv_id):
+        result = []
+        for row in sorted(
+            self.conversation_lines.get(conv_id, ()), key=lambda r: self.line_sorts[r]
+        ):
+            c = self.character_index.get(self.line_characters[row])
+            if c is None or self.line_movies[row] not in self.movie_index:
+                continue
+            result.append(
+                ConversationLineRow(
+                    self.line_ids[row], conv_id, self.line_movies[row],
+                    self.line_sorts[row], self.names[c], self.line_texts[row],
+                )
+            )
+        return result
+
+
+# The loaded snapshot, or None when the handlers should query Postgres.
+current = None
+
+ENABLED = db.env_flag("SNAPSHOT_MODE")
+
+# Conversations committed while a load runs, as add_conversation arguments;
+# None when no load is running.
+_committed_during_load = None
+
+
+def add_conversation(movie_id, conv_id, c1, c2, lines):
+    """Applies a committed conversation to the current snapshot and to the
+    one being loaded, if any."""
+    if _committed_during_load is not None:
+        _committed_during_load.append((movie_id, conv_id, c1, c2, lines))
+    if current is not None:
+        current.add_conversation(movie_id, conv_id, c1, c2, lines)
+
+
+async def load():
+    global current, _committed_during_load
+    _committed_during_load = []
+    try:
+        snapshot = Snapshot()
+        async with db.connect() as conn:
+            await snapshot.load(conn)
+
+        # replay what committed after the load's transaction began; anything
+        # that committed before it is already in the snapshot
+        for movie_id, conv_id, c1, c2, lines in _committed_during_load:
+            if conv_id not in snapshot.conversation_index:
+                snapshot.add_conversation(movie_id, conv_id, c1, c2, lines)
+        current = snapshot
+    finally:
+        _committed_during_load = None
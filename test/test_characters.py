@@ -31,6 +31,16 @@ def test_get_character2():
         assert response.json() == json.load(f)
 
 
+def test_get_character_paged():
+    response = client.get("/characters/2?limit=1&offset=1")
+    assert response.status_code == 200
+
+    with open("test/characters/2.json", encoding="utf-8") as f:
+        expected = json.load(f)
+    expected["top_conversations"] = expected["top_conversations"][1:2]
+    assert response.json() == expected
+
+
 def test_sort_filter():
     response = client.get(
         "/characters/?name=amy&limit=50&offset=0&sort=number_of_lines"
@@ -83,6 +93,82 @@ def test_sort_filter_3():
         assert response.json() == json.load(f)
 
 
+def test_cursor():
+    # paging 41-49 by offset then following the cursor lands on offset=50
+    response = client.get("/characters/?name=a&limit=9&offset=41&sort=movie")
+    assert response.status_code == 200
+
+    response = client.get(
+        "/characters/",
+        params={
+            "name": "a",
+            "limit": 9,
+            "sort": "movie",
+            "cursor": response.headers["X-Next-Cursor"],
+        },
+    )
+    assert response.status_code == 200
+
+    with open(
+        "test/characters/characters-name=a&limit=9&offset=50&sort=movie.json",
+        encoding="utf-8",
+    ) as f:
+        assert response.json() == json.load(f)
+
+
+def test_cursor_400():
+    response = client.get("/characters/?cursor=garbage")
+    assert response.status_code == 400
+
+
+def test_get_characters_batch():
+    response = client.get("/characters:batch?ids=7421,2,400")
+    assert response.status_code == 200
+
+    with open("test/characters/7421.json", encoding="utf-8") as f:
+        assert response.json()["results"]["7421"] == json.load(f)
+    with open("test/characters/2.json", encoding="utf-8") as f:
+        assert response.json()["results"]["2"] == json.load(f)
+    assert response.json()["missing"] == [400]
+
+
 def test_404():
     response = client.get("/characters/400")
     assert response.status_code == 404
+
+
+def test_character_neighbors():
+    partners = client.get("/characters/2?limit=250").json()["top_conversations"]
+
+    response = client.get("/characters/2/neighbors?depth=2")
+    assert response.status_code == 200
+    neighbors = response.json()["neighbors"]
+
+    direct = [n for n in neighbors if n["depth"] == 1]
+    assert {n["character_id"] for n in direct} == {p["character_id"] for p in partners}
+    assert all(n["via"] == 2 for n in direct)
+    assert {n["character_id"]: n["lines_together"] for n in direct} == {
+        p["character_id"]: p["number_of_lines_together"] for p in partners
+    }
+    assert [n["depth"] for n in neighbors] == sorted(n["depth"] for n in neighbors)
+
+
+def test_character_path():
+    partner = client.get("/characters/2").json()["top_conversations"][0]
+
+    response = client.get(f"/characters/2/path/{partner['character_id']}")
+    assert response.status_code == 200
+    assert response.json()["length"] == 1
+    assert [c["character_id"] for c in response.json()["path"]] == [
+        2,
+        partner["character_id"],
+    ]
+    assert (
+        response.json()["path"][1]["lines_together"]
+        == partner["number_of_lines_together"]
+    )
+
+
+def test_character_path_404():
+    response = client.get("/characters/2/path/99999999")
+    assert response.status_code == 404
@@ -1,8 +1,10 @@
 from fastapi.testclient import TestClient
 
+from src.api import conversations
 from src.api.server import app
 
 import json
+import time
 
 client = TestClient(app)
 
@@ -49,6 +51,37 @@ def test_add_conversation():
             ]
         })
     assert response.status_code == 200
+    conversation_id = response.json()["conversation_id"]
+
+    response = client.get(f"/line-sort/{conversation_id}")
+    assert response.status_code == 200
+    assert [line["line_sort"] for line in response.json()] == list(range(1, 9))
+    assert response.json()[0]["line_text"] == "hello"
+
+
+def test_add_conversation_same_character():
+    response = client.post(
+        "/movies/240/conversations/",
+        json={"character_1_id": 3642, "character_2_id": 3642, "lines": []})
+    assert response.status_code == 400
+
+
+def test_add_conversation_wrong_movie():
+    response = client.post(
+        "/movies/44/conversations/",
+        json={"character_1_id": 3642, "character_2_id": 3640, "lines": []})
+    assert response.status_code == 400
+
+
+def test_add_conversation_wrong_speaker():
+    response = client.post(
+        "/movies/240/conversations/",
+        json={
+            "character_1_id": 3642,
+            "character_2_id": 3640,
+            "lines": [{"character_id": 695, "line_text": "hello"}],
+        })
+    assert response.status_code == 400
 
 
 def test_lines_recently_added():
@@ -61,3 +94,152 @@ def test_lines_recently_added():
     assert response.json()[0]["character2_name"] == "HEATHER"
     assert response.json()[0]["movie_id"] == 240
 
+
+def test_add_conversation_invalidates_cache():
+    # the character detail is cached by the first read, the write must evict it
+    def lines_together():
+        response = client.get("/characters/3642")
+        assert response.status_code == 200
+        for conv in response.json()["top_conversations"]:
+            if conv["character_id"] == 3640:
+                return conv["number_of_lines_together"]
+        return 0
+
+    before = lines_together()
+    response = client.post(
+        "/movies/240/conversations/",
+        json={
+            "character_1_id": 3642,
+            "character_2_id": 3640,
+            "lines": [
+                {"character_id": 3642, "line_text": "did you get my message?"},
+                {"character_id": 3640, "line_text": "i did."},
+            ]
+        })
+    assert response.status_code == 200
+    assert lines_together() == before + 2
+
+
+def test_add_conversations_bulk():
+    response = client.post(
+        "/movies/240/conversations:bulk",
+        json=[
+            {
+                "character_1_id": 3642,
+                "character_2_id": 3640,
+                "lines": [
+                    {"character_id": 3642, "line_text": "first"},
+                    {"character_id": 3640, "line_text": "second"},
+                ],
+            },
+            {"character_1_id": 3642, "character_2_id": 3642, "lines": []},
+        ])
+    assert response.status_code == 200
+
+    created, errors = response.json()["conversations"], response.json()["errors"]
+    assert [c["index"] for c in created] == [0]
+    assert [e["index"] for e in errors] == [1]
+
+    response = client.get(f"/line-sort/{created[0]['conversation_id']}")
+    assert response.status_code == 200
+    assert [line["line_text"] for line in response.json()] == ["first", "second"]
+
+
+def test_add_conversation_changes_etag():
+    etag = client.get("/movies/240").headers["ETag"]
+
+    response = client.post(
+        "/movies/240/conversations/",
+        json={
+            "character_1_id": 3642,
+            "character_2_id": 3640,
+            "lines": [{"character_id": 3642, "line_text": "are you there?"}],
+        })
+    assert response.status_code == 200
+
+    response = client.get("/movies/240", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_add_conversation_updates_movie_stats():
+    before = client.get("/movies/240/stats").json()
+
+    response = client.post(
+        "/movies/240/conversations/",
+        json={
+            "character_1_id": 3642,
+            "character_2_id": 3640,
+            "lines": [
+                {"character_id": 3642, "line_text": "one two three"},
+                {"character_id": 3640, "line_text": "  four   five "},
+            ]
+        })
+    assert response.status_code == 200
+    conversation_id = response.json()["conversation_id"]
+
+    after = client.get("/movies/240/stats", params={"longest": 50}).json()
+    assert after["num_conversations"] == before["num_conversations"] + 1
+    assert after["num_lines"] == before["num_lines"] + 2
+    assert after["num_words"] == before["num_words"] + 5
+    assert sum(after["lines_by_gender"].values()) == after["num_lines"]
+
+    words = {c["character_id"]: c["num_words"] for c in after["characters"]}
+    words_before = {c["character_id"]: c["num_words"] for c in before["characters"]}
+    assert words[3642] == words_before.get(3642, 0) + 3
+    assert words[3640] == words_before.get(3640, 0) + 2
+
+    conversation = {
+        "conversation_id": conversation_id, "character_1_id": 3642,
+        "character_2_id": 3640, "num_lines": 2,
+    }
+    shortest = after["longest_conversations"][-1]["num_lines"]
+    assert conversation in after["longest_conversations"] or shortest >= 2
+
+
+def test_add_conversation_queued(monkeypatch):
+    monkeypatch.setattr(conversations, "QUEUE_ENABLED", True)
+    # entering the client runs the startup hooks, which start the writer
+    with TestClient(app) as queued_client:
+        response = queued_client.post(
+            "/movies/240/conversations/",
+            json={
+                "character_1_id": 3642,
+                "character_2_id": 3640,
+                "lines": [
+                    {"character_id": 3642, "line_text": "queued hello"},
+                    {"character_id": 3640, "line_text": "queued hi"},
+                ]
+            })
+        assert response.status_code == 202
+        assert response.json()["status"] == "queued"
+        conversation_id = response.json()["conversation_id"]
+
+        for _ in range(100):
+            status = queued_client.get(
+                f"/conversations/{conversation_id}/status"
+            ).json()
+            if status["status"] != "queued":
+                break
+            time.sleep(0.05)
+        assert status == {"conversation_id": conversation_id, "status": "committed"}
+
+        response = queued_client.get(f"/line-sort/{conversation_id}")
+        assert [line["line_text"] for line in response.json()] == [
+            "queued hello",
+            "queued hi",
+        ]
+
+        # invalid conversations are still refused up front
+        response = queued_client.post(
+            "/movies/240/conversations/",
+            json={"character_1_id": 3642, "character_2_id": 3642, "lines": []},
+        )
+        assert response.status_code == 400
+
+    assert conversations.write_queue is None
+
+
+def test_conversation_status_404():
+    response = client.get("/conversations/99999999/status")
+    assert response.status_code == 404
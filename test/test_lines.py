@@ -67,6 +67,27 @@ def test_sort_filter_4():
         assert response.json() == json.load(f)
 
 
+def test_cursor():
+    response = client.get("/lines?movie_id=11&limit=1")
+    assert response.status_code == 200
+
+    response = client.get(
+        "/lines",
+        params={
+            "movie_id": 11,
+            "limit": 5,
+            "cursor": response.headers["X-Next-Cursor"],
+        },
+    )
+    assert response.status_code == 200
+
+    with open(
+        "test/lines/lines-movie_id=11&limit=5&offset=1.json",
+        encoding="utf-8",
+    ) as f:
+        assert response.json() == json.load(f)
+
+
 def test_sort_conv_lines():
     response = client.get(
         "/line-sort/40700"
@@ -80,10 +101,94 @@ def test_sort_conv_lines():
         assert response.json() == json.load(f)
 
 
+def test_export_movie_lines():
+    response = client.get("/movies/289/lines.ndjson")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    exported = [json.loads(line) for line in response.text.splitlines()]
+    with open(
+        "test/lines/lines-line-sort-40700.json",
+        encoding="utf-8",
+    ) as f:
+        assert [
+            line for line in exported if line["conversation_id"] == 40700
+        ] == json.load(f)
+
+
+def test_export_movie_lines_404():
+    response = client.get("/movies/1/lines.ndjson")
+    assert response.status_code == 404
+
+
+def test_get_lines_batch():
+    response = client.get("/lines:batch?ids=49,400")
+    assert response.status_code == 200
+
+    with open("test/lines/49.json", encoding="utf-8") as f:
+        assert response.json()["results"]["49"] == json.load(f)
+    assert response.json()["missing"] == [400]
+
+
 def test_404():
     response = client.get("/lines/400")
     assert response.status_code == 404
 
 def test_2_422():
     response = client.get("/line-sort/abc")
-    assert response.status_code == 422
\ No newline at end of file
+    assert response.status_code == 422
+
+def test_include_total():
+    # a conversation filter is counted exactly even when asked to approximate
+    response = client.get("/lines/?conversation_id=46&include_total=approximate")
+    assert response.status_code == 200
+    assert int(response.headers["X-Total-Count"]) == len(response.json())
+
+
+def test_search_lines():
+    response = client.get("/lines/search?q=love&movie_id=44&limit=5")
+    assert response.status_code == 200
+    found = response.json()
+    assert found
+
+    ranks = [line["rank"] for line in found]
+    assert ranks == sorted(ranks, reverse=True)
+    for line in found:
+        assert line["movie_id"] == 44
+        assert "<b>" in line["snippet"].lower()
+
+    if "X-Next-Cursor" in response.headers:
+        response = client.get(
+            "/lines/search?q=love&movie_id=44&limit=5&cursor="
+            + response.headers["X-Next-Cursor"]
+        )
+        assert response.status_code == 200
+        next_page = response.json()
+        assert not {line["line_id"] for line in found} & {
+            line["line_id"] for line in next_page
+        }
+        assert all(line["rank"] <= ranks[-1] for line in next_page)
+
+
+def test_search_lines_finds_new_conversation():
+    response = client.post(
+        "/movies/240/conversations/",
+        json={
+            "character_1_id": 3642,
+            "character_2_id": 3640,
+            "lines": [
+                {"character_id": 3642, "line_text": "have you seen the zeppelins?"},
+                {"character_id": 3640, "line_text": "no."},
+            ]
+        })
+    assert response.status_code == 200
+    conversation_id = response.json()["conversation_id"]
+
+    response = client.get("/lines/search?q=zeppelin&character_id=3642")
+    assert response.status_code == 200
+    assert conversation_id in [line["conversation_id"] for line in response.json()]
+
+
+def test_search_lines_requires_query():
+    response = client.get("/lines/search")
+    assert response.status_code == 422
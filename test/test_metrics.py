@@ -0,0 +1,35 @@
+import re
+
+from fastapi.testclient import TestClient
+
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_server_timing():
+    response = client.get("/characters/7421?limit=3")
+    assert response.status_code == 200
+
+    timing = response.headers["Server-Timing"]
+    assert re.search(r"db;dur=[\d.]+", timing)
+    assert re.search(r"serialize;dur=[\d.]+", timing)
+    queries = int(re.search(r"db-queries;desc=(\d+)", timing).group(1))
+    assert queries >= 1
+
+
+def test_metrics():
+    client.get("/movies/44")
+    response = client.get("/metrics/")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+
+    assert "# TYPE http_request_duration_seconds histogram" in response.text
+    assert (
+        'http_request_duration_seconds_count{route="/movies/{movie_id}"}'
+        in response.text
+    )
+    assert (
+        'http_request_db_queries_bucket{route="/movies/{movie_id}",le="+Inf"}'
+        in response.text
+    )
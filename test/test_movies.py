@@ -77,6 +77,104 @@ def test_sort_filter_3():
         assert response.json() == json.load(f)
 
 
+def test_cursor():
+    response = client.get("/movies/?limit=1&offset=49")
+    assert response.status_code == 200
+
+    response = client.get(
+        "/movies/", params={"limit": 1, "cursor": response.headers["X-Next-Cursor"]}
+    )
+    assert response.status_code == 200
+
+    with open(
+        "test/movies/movies-limit=1&offset=50.json",
+        encoding="utf-8",
+    ) as f:
+        assert response.json() == json.load(f)
+
+
+def test_not_modified():
+    response = client.get("/movies/44")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    response = client.get("/movies/44", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    response = client.get("/movies/436", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    response = client.get("/movies/999999999", headers={"If-None-Match": "*"})
+    assert response.status_code == 404
+
+
+def test_get_movies_batch():
+    response = client.get("/movies:batch?ids=44,436,1")
+    assert response.status_code == 200
+
+    with open("test/movies/44.json", encoding="utf-8") as f:
+        assert response.json()["results"]["44"] == json.load(f)
+    with open("test/movies/436.json", encoding="utf-8") as f:
+        assert response.json()["results"]["436"] == json.load(f)
+    assert response.json()["missing"] == [1]
+
+
+def test_get_movies_batch_422():
+    response = client.get("/movies:batch?ids=44,abc")
+    assert response.status_code == 422
+
+
 def test_404():
     response = client.get("/movies/1")
     assert response.status_code == 404
+
+
+def test_include_total():
+    response = client.get("/movies/?name=big&limit=250&include_total=exact")
+    assert response.status_code == 200
+    assert int(response.headers["X-Total-Count"]) == len(response.json())
+
+    response = client.get("/movies/?limit=1&include_total=approximate")
+    assert response.status_code == 200
+    assert int(response.headers["X-Total-Count-Estimate"]) > 0
+
+
+def test_movie_stats():
+    response = client.get("/movies/44/stats")
+    assert response.status_code == 200
+    stats = response.json()
+
+    assert stats["movie_id"] == 44
+    assert sum(c["num_lines"] for c in stats["characters"]) == stats["num_lines"]
+    assert sum(c["num_words"] for c in stats["characters"]) == stats["num_words"]
+    assert sum(stats["lines_by_gender"].values()) == stats["num_lines"]
+
+    # the first five characters are get_movie's top characters
+    top = client.get("/movies/44").json()["top_characters"]
+    assert [
+        {key: c[key] for key in ("character_id", "character", "num_lines")}
+        for c in stats["characters"][:5]
+    ] == top
+
+    longest = [c["num_lines"] for c in stats["longest_conversations"]]
+    assert len(longest) <= 5
+    assert longest == sorted(longest, reverse=True)
+
+
+def test_movie_stats_not_found():
+    response = client.get("/movies/99999999/stats")
+    assert response.status_code == 404
+
+
+def test_movie_centrality():
+    response = client.get("/movies/44/centrality")
+    assert response.status_code == 200
+    ranked = response.json()
+    assert ranked
+
+    betweenness = [c["betweenness"] for c in ranked]
+    assert betweenness == sorted(betweenness, reverse=True)
+    for c in ranked:
+        assert 0 <= c["closeness"] <= 1
+        assert 0 <= c["betweenness"] <= 1
@@ -0,0 +1,32 @@
+import asyncio
+
+import sqlalchemy
+
+from src import database as db
+
+
+def test_declared_tables_match_database():
+    with db.get_engine().connect() as conn:
+        assert db.schema_differences(conn) == []
+
+
+def test_sync_copy_keeps_nulls_apart_from_empty_strings():
+    records = [(1, None, ""), (2, "tab\there", "back\\slash\nnewline")]
+
+    async def copy(conn):
+        await db.copy_records(
+            db.SyncConnection(conn), "copy_check", ["id", "a", "b"], records
+        )
+
+    with db.get_engine().connect() as conn:
+        conn.execute(
+            sqlalchemy.text(
+                "CREATE TEMPORARY TABLE copy_check (id integer, a text, b text)"
+            )
+        )
+        asyncio.run(copy(conn))
+        rows = conn.execute(
+            sqlalchemy.text("SELECT id, a, b FROM copy_check ORDER BY id")
+        )
+        assert [tuple(row) for row in rows] == records
+        conn.rollback()
@@ -0,0 +1,41 @@
+from fastapi.testclient import TestClient
+
+from src import slow_queries
+from src.api.server import app
+
+client = TestClient(app)
+
+
+def test_normalize():
+    assert slow_queries.normalize(
+        "SELECT name\n  FROM characters WHERE name = 'it''s' AND num_lines > 5 LIMIT $1"
+    ) == "SELECT name FROM characters WHERE name = ? AND num_lines > ? LIMIT $1"
+
+
+def test_slow_query_log(monkeypatch):
+    monkeypatch.setattr(slow_queries, "THRESHOLD", 0)
+    monkeypatch.setattr(slow_queries, "EXPLAIN_RATE", 1)
+    monkeypatch.setattr(slow_queries, "REDACT", True)
+
+    response = client.get("/characters/?sort=number_of_lines&limit=7")
+    assert response.status_code == 200
+    # wait for the EXPLAINs queued so far
+    slow_queries._explainer.submit(lambda: None).result()
+
+    entries = [
+        entry
+        for entry in client.get("/slowqueries/").json()
+        if entry["route"] == "/characters/"
+        and "ORDER BY c.num_lines DESC" in entry["statement"]
+    ]
+    assert entries
+    entry = entries[0]
+    assert all(
+        isinstance(value, str)
+        for value in (
+            entry["parameters"].values()
+            if isinstance(entry["parameters"], dict)
+            else entry["parameters"]
+        )
+    )
+    assert "actual time" in entry["plan"]
@@ -0,0 +1,72 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+from src import cache, snapshot
+from src.api.server import app
+
+client = TestClient(app)
+
+PATHS = [
+    "/characters/7421",
+    "/characters/2?limit=1&offset=1",
+    "/characters/?name=a&limit=9&offset=50&sort=movie",
+    "/characters/?name=amy&limit=50&offset=0&sort=number_of_lines",
+    "/characters/?limit=250&sort=number_of_lines",
+    "/movies/44",
+    "/movies/436",
+    "/movies/?name=big&limit=50&offset=0&sort=rating",
+    "/movies/?limit=250&offset=200&sort=year",
+    "/lines/49",
+    "/lines/?movie_id=11&limit=5&offset=1",
+    "/lines/?movie_id=11&conversation_id=46",
+    "/lines/?sort=conversation_id&limit=250",
+    "/lines/?sort=movie_id&limit=250&offset=1000",
+    "/line-sort/40700",
+]
+
+
+def get_all(paths):
+    cache.detail_cache.clear()
+    return [client.get(path) for path in paths]
+
+
+def test_snapshot_matches_database():
+    from_db = get_all(PATHS)
+
+    asyncio.run(snapshot.load())
+    try:
+        from_snapshot = get_all(PATHS)
+    finally:
+        snapshot.current = None
+
+    for path, expected, response in zip(PATHS, from_db, from_snapshot):
+        assert response.status_code == expected.status_code, path
+        assert response.json() == expected.json(), path
+        cursor = expected.headers.get("X-Next-Cursor")
+        assert response.headers.get("X-Next-Cursor") == cursor, path
+
+
+def test_snapshot_cursor():
+    asyncio.run(snapshot.load())
+    try:
+        first = client.get("/characters/?sort=number_of_lines&limit=5")
+        second = client.get(
+            "/characters/?sort=number_of_lines&limit=5&cursor="
+            + first.headers["X-Next-Cursor"]
+        )
+        both = client.get("/characters/?sort=number_of_lines&limit=10")
+    finally:
+        snapshot.current = None
+
+    assert first.json() + second.json() == both.json()
+
+
+def test_snapshot_404():
+    asyncio.run(snapshot.load())
+    try:
+        assert client.get("/characters/400").status_code == 404
+        assert client.get("/movies/1").status_code == 404
+        assert client.get("/lines/400").status_code == 404
+    finally:
+        snapshot.current = None